@@ -4,15 +4,20 @@ Harvester for DDI2 formats
 '''
 
 #pylint: disable-msg=E1101,E0611,F0401
-import inspect
+import functools
+import hashlib
 import logging
 import re
 import socket
 import StringIO
+import sys
+import tempfile
+import threading
 import traceback
 import warnings
 
 
+from bs4 import BeautifulSoup
 import lxml.etree as etree
 from iso639 import languages
 from pylons import config
@@ -24,9 +29,9 @@ from ckan.lib.base import h
 import ckan.model as model
 import ckan.model.authz as authz
 import ckanext.kata.utils as utils
-import ckanext.oaipmh.importcore as importcore
 
 from ckanext.kata.utils import generate_pid
+import flattener
 
 log = logging.getLogger(__name__)
 socket.setdefaulttimeout(30)
@@ -53,102 +58,416 @@ DATE_REGEX = re.compile(
     (0[1-9]|[12][0-9]|3[01])?
     """,
     re.VERBOSE)
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+# DTDs and external entities are never needed, never fetch them.
+_XML_PARSER_OPTIONS = dict(resolve_entities=False, no_network=True,
+                           huge_tree=True)
+# XML parsers and compiled XPaths are made for each thread, as lxml lets only
+# one thread at a time use a parser or an XPath.
+_thread_data = threading.local()
+# Tags searched by the extractors of DataConverter, collected in one pass over
+# the document, see DocumentIndex.
+INDEXED_TAGS = ('AuthEnty', 'othId', 'prodDate', 'version', 'geogCover',
+                'timePrd')
+# Variable CSVs are kept in memory up to this size, then spooled to disk.
+CSV_SPOOL_SIZE = 1024 * 1024
+
+# Metadata fields read from a DDI document: field name -> (XPaths in order of
+# preference, mandatory). XPaths wrapped in string() give the text or attribute
+# value of the first match, other XPaths give a list of elements. The XPaths
+# are compiled once per thread, see DataConverter.fields.
+FIELDS = {
+    'language': (["string(@xml:lang)"], False),
+    'titles': (["stdyDscr/citation/titlStmt/*[self::titl or self::parTitl]",
+                "docDscr/citation/titlStmt/*[self::titl or self::parTitl]"],
+               True),
+    'license': (["stdyDscr/dataAccs/useStmt"], False),
+    'contact_names': (["stdyDscr/citation/distStmt//contact",
+                       "stdyDscr/citation/distStmt//distrbtr",
+                       "docDscr/citation/prodStmt//producer"], True),
+    'contact_affiliation': (
+        ["string(stdyDscr/citation/prodStmt/producer/@affiliation)"], True),
+    'contact_email': (["string(stdyDscr/citation/distStmt/contact/@email)"],
+                      True),
+    'contact_phone': (["string(docDscr/citation/holdings/@callno)",
+                       "string(stdyDscr/citation/holdings/@callno)"], False),
+    'contact_URL': (["string(stdyDscr/dataAccs/setAvail/accsPlac/@URI)",
+                     "string(stdyDscr/citation/distStmt/contact/@URI)",
+                     "string(stdyDscr/citation/distStmt/distrbtr/@URI)"],
+                    False),
+    'name_prefix': (["string(stdyDscr/citation/titlStmt/IDNo/@agency)",
+                     "string(docDscr/citation/titlStmt/IDNo/@agency)"], True),
+    'name_id': (["string(stdyDscr/citation/titlStmt/IDNo)",
+                 "string(docDscr/citation/titlStmt/IDNo)"], True),
+    'orig_web_page': (["string(docDscr/citation/holdings/@URI)"], False),
+    'owner': (["string(stdyDscr/citation/prodStmt/producer)",
+               "string(stdyDscr/citation/rspStmt/AuthEnty)",
+               "string(docDscr/citation/prodStmt/producer)"], True),
+    'description': (["stdyDscr/stdyInfo/abstract//p",
+                     "stdyDscr/citation/serStmt/serInfo//p"], False),
+    'collection_dates': (
+        ["stdyDscr/stdyInfo/sumDscr//collDate[@event='start']"], False),
+    'data_collectors': (["stdyDscr/method/dataColl//dataCollector"], False),
+    'production_dates': (["stdyDscr/citation/prodStmt//prodDate"], False),
+}
 
 
 # TODO Nice to have: decorator for this decorator to separate mandatory and not
-def ExceptReturn(exceptions, returns=u'', mandatory_field=False):
+def ExceptReturn(exceptions, returns=u'', mandatory_field=False, field=None):
     '''Decorator to handle exceptions in the import stage in controlled manner.
 
     Prevents the whole import to fail with flawed harvest objects or in the case
     of optional metadata. Collects all deficiencies of harvest objects to
-    self.errors to be showed in WUI.
+    the errors of the conversion to be showed in WUI.
+
+    The failed field is identified by 'field' given here, so handling a
+    missing value doesn't need any stack inspection.
 
     :param exceptions: Exceptions to catch.
     :type exceptions: single exception or tuple of exceptions
+    :param field: name of the field read by the decorated method, defaults to
+        the name of the method
+    :type field: string
     '''
     def decorator(f):
+        field_name = field or f.__name__
+
+        @functools.wraps(f)
         def call(*args, **kwargs):
             try:
                 return f(*args, **kwargs)
             except exceptions as e:
                 self_ = args[0]  # Decorator intercepts method args, 1st is self
-                # If inspecting is too slow remove it and use
-                # 'carg=args[2] or args[1]' in format()'s below.
-                frame = inspect.currentframe()  # To show caller argument
-                caller_record = inspect.getouterframes(frame)[1]
-                line_num = caller_record[2]
-                call_line = caller_record[4][0]
-                call_arg = call_line.strip().split(')', 1)[0]
-                del frame  # To remove possible reference cycles
                 if mandatory_field:
+                    # Searched tags and attributes tell more than the field of
+                    # the generic getters. 1st arg is start tag.
+                    call_arg = ', '.join([field_name] + [
+                        repr(arg) for arg in args[2:]
+                        if isinstance(arg, basestring)])
+                    line_num = sys._getframe(1).f_lineno
                     log.error('Unable to read mandatory value: {etype}: {ex} at'
                               ' {carg} (line {li})'.format(
                         etype=e.__class__.__name__, ex=e, li=line_num,
                         carg=call_arg))
-                    self_.errors.append(('{etype}: {ex} at {carg}'.format(
+                    self_.conversion.add_error('{etype}: {ex} at {carg}'.format(
                         etype=e.__class__.__name__, ex=e, carg=call_arg),
-                                         line_num))
+                                               line_num)
                 else:
-                    log.info('Unable to read optional value: {carg} (line {li})'
-                       .format(li=line_num, carg=call_arg))
+                    log.info('Unable to read optional value: %s', field_name)
                 return returns
+        call.field = field_name
         return call
     return decorator
 
 
+def _get_parser(encoding=None):
+    '''Return the XML parser of the calling thread for documents in
+    'encoding', or in the encoding they declare if None.
+    '''
+    parsers = getattr(_thread_data, 'parsers', None)
+    if parsers is None:
+        parsers = _thread_data.parsers = {}
+    if encoding not in parsers:
+        parsers[encoding] = etree.XMLParser(encoding=encoding,
+                                            **_XML_PARSER_OPTIONS)
+    return parsers[encoding]
+
+
+def parse_ddi(original_xml):
+    '''Parse a DDI document to an lxml element tree.
+
+    The document is parsed only once and the same tree is used both for
+    metadata extraction and flattening. BeautifulSoup is used only to repair
+    malformed documents which lxml refuses to parse. Namespaced documents
+    (eg. DDI 2.5) are converted to plain tag names so that the same paths
+    work for all DDI2 variants.
+
+    :param original_xml: the DDI document
+    :type original_xml: string
+    :returns: root element (codeBook) of the document
+    :rtype: lxml.etree._Element
+    :raises: lxml.etree.XMLSyntaxError if the document can't be repaired
+    '''
+    parser = _get_parser()
+    if isinstance(original_xml, unicode):
+        original_xml = original_xml.encode('utf-8')
+        parser = _get_parser('utf-8')
+    try:
+        root = etree.fromstring(original_xml, parser)
+    except etree.XMLSyntaxError, err:
+        log.debug('Malformed XML, repairing with BeautifulSoup: {er}'
+                  .format(er=err))
+        root = etree.fromstring(str(BeautifulSoup(original_xml, 'xml')),
+                                _get_parser())
+    if root.tag.startswith('{'):
+        _strip_namespaces(root)
+    return root
+
+
+def _strip_namespaces(root):
+    '''Remove namespaces of the element names in tree 'root' in place.
+    '''
+    for el in root.iter(etree.Element):
+        if el.tag.startswith('{'):
+            el.tag = etree.QName(el).localname
+    etree.cleanup_namespaces(root)
+
+
+def _text(el):
+    '''Return all the text inside element 'el' (like bs4's Tag.text).
+    '''
+    return u''.join(el.itertext())
+
+
+def _get_text(el, separator=u''):
+    '''Return all the text inside element 'el' joined with 'separator' (like
+    bs4's Tag.get_text()). Whitespace-only strings are collapsed to a single
+    newline or space.
+    '''
+    return separator.join([(u'\n' if u'\n' in s else u' ') if s.isspace() else s
+                           for s in el.itertext()])
+
+
+def _string(el):
+    '''Return the text of element 'el' if it is the only content of the
+    element, else None (like bs4's Tag.string).
+    '''
+    if not len(el):
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return _string(el[0])
+    return None
+
+
+def _find_all(start_tag, *names, **attrs):
+    '''Find all descendants of 'start_tag' by tag names and attribute values
+    (like bs4's Tag.find_all()).
+
+    :param start_tag: element to start search
+    :type start_tag: lxml.etree._Element
+    :param names: searched tag names, all tags if none given
+    :type names: zero or more strings
+    :param attrs: searched attributes, value is a string or a compiled regex
+    :type attrs: zero or more key-value pairs
+    :returns: matching elements in document order
+    :rtype: list
+    '''
+    return _filter_by_attrs(
+        start_tag.iterdescendants(*(names or (etree.Element,))), attrs)
+
+
+def _filter_by_attrs(elements, attrs):
+    '''Return the elements having the attribute values of 'attrs', see
+    :func:`_find_all`.
+    '''
+    result_set = []
+    for tag in elements:
+        for key, value in attrs.iteritems():
+            attr = tag.get(key)
+            if attr is None:
+                break
+            if hasattr(value, 'search'):
+                if not value.search(attr):
+                    break
+            elif attr != value:
+                break
+        else:
+            result_set.append(tag)
+    return result_set
+
+
+class DocumentIndex(object):
+    '''Elements of a DDI document by tag name, collected in one pass over
+    the document. Searching the index replaces a walk of
+    the subtree for each extracted field.
+
+    The document is not changed by the conversion, so the index stays valid.
+
+    :param root: root element of the document
+    :type root: lxml.etree._Element
+    :param tags: indexed tag names
+    :type tags: iterable of strings
+    '''
+
+    def __init__(self, root, tags=INDEXED_TAGS):
+        self.root = root
+        self.tags = frozenset(tags)
+        # Tag -> [element] in document order
+        self._elements = dict((tag, []) for tag in self.tags)
+        for el in root.iter(*self.tags):
+            self._elements[el.tag].append(el)
+
+    def covers(self, start_tag, name):
+        '''Check if descendants of 'start_tag' named 'name' can be found
+        in the index.
+        '''
+        return name in self.tags and start_tag is not None and \
+            start_tag.getroottree().getroot() is self.root
+
+    def find_all(self, start_tag, name, **attrs):
+        '''Find descendants of 'start_tag' by tag name and attribute values
+        like :func:`_find_all`. See :meth:`covers`.
+
+        :param start_tag: element to start search
+        :type start_tag: lxml.etree._Element
+        :param name: searched tag name
+        :type name: string
+        :param attrs: searched attributes, value is a string or a compiled
+            regex
+        :type attrs: zero or more key-value pairs
+        :returns: matching elements in document order
+        :rtype: list
+        '''
+        elements = self._elements[name]
+        if start_tag is not self.root:
+            elements = [el for el in elements
+                        if any(ancestor is start_tag
+                               for ancestor in el.iterancestors())]
+        return _filter_by_attrs(elements, attrs)
+
+
+def _iter_ddi_vars(original_xml, recover=False):
+    '''Iterate over the <var> elements of DDI document 'original_xml'
+    without building the whole tree. Each <var> is yielded when it closes and
+    is cleared, together with the elements before it, when the next one is
+    requested. Use the yielded element before advancing the iterator.
+
+    :param original_xml: DDI document
+    :type original_xml: string
+    :param recover: continue parsing a malformed document instead of
+        raising, variables in the broken parts may be lost
+    :type recover: bool
+    :returns: <var> elements with namespaces removed
+    :rtype: iterator
+    :raises lxml.etree.XMLSyntaxError: if the document is malformed and
+        'recover' is not set
+    '''
+    kwargs = dict(events=('end',), tag='{*}var', resolve_entities=False,
+                  no_network=True, huge_tree=True, recover=recover)
+    if isinstance(original_xml, unicode):
+        original_xml = original_xml.encode('utf-8')
+        kwargs['encoding'] = 'utf-8'
+    for _, var in etree.iterparse(StringIO.StringIO(original_xml), **kwargs):
+        if var.tag.startswith('{'):
+            _strip_namespaces(var)
+        yield var
+        var.clear()
+        parent = var.getparent()
+        while var.getprevious() is not None:
+            del parent[0]
+
+
+def content_hash(xml):
+    '''Return the SHA-1 hex digest of document 'xml'.
+    '''
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return hashlib.sha1(xml).hexdigest()
+
+
+def storage_url(label):
+    '''Return the URL of a file in the OFS storage.
+
+    :param label: storage label of the file
+    :type label: string
+    :rtype: string
+    '''
+    return config.get('ckan.site_url') + h.url_for('storage_file', label=label)
+
+
+def store_document(xml, directory, guid, digest):
+    '''Save document 'xml' to the OFS storage under a label kept for its
+    'guid', so that a changed document replaces the previous one and keeps
+    its URL. The 'digest' of the document is kept in the metadata of the
+    stored file and an identical document is not written again.
+
+    :param xml: the document
+    :type xml: string
+    :param directory: storage directory, the harvest source id
+    :type directory: string
+    :param guid: guid of the document, its URL
+    :type guid: string
+    :param digest: hex digest of the document
+    :type digest: string
+    :returns: storage label of the document
+    :rtype: string
+    :raises IOError: if the storage is not available
+    '''
+    label = '{directory}/{key}.xml'.format(directory=directory,
+                                          key=content_hash(guid))
+    ofs = storage.get_ofs()
+    if not ofs.exists(storage.BUCKET, label) or \
+            ofs.get_metadata(storage.BUCKET, label).get('sha1') != digest:
+        ofs.put_stream(storage.BUCKET, label, xml, {'sha1': digest})
+    return label
+
+
+def load_document(label):
+    '''Read a document saved with :func:`store_document`.
+
+    :param label: storage label of the document
+    :type label: string
+    :rtype: string
+    :raises IOError: if the document can't be read
+    '''
+    return storage.get_ofs().get_stream(storage.BUCKET, label).read()
+
+
 def _collect_attribs(el):
     '''Collect attributes of a tag 'el' to a string with (k,v) value where k is
     the attribute name and v is the attribute value.
     '''
     astr = ""
-    if el.attrs:
-        for k, v in el.attrs.items():
-            astr += "(%s,%s)" % (k, v)
+    for k, v in el.attrib.items():
+        astr += "(%s,%s)" % (k, v)
     return astr
 
 
 def _construct_csv(var, heads):
+    '''Return the CSV row of <var> element 'var'. The 'range' and 'item'
+    cells hold the attributes of <valrng><range> and <invalrng><item> as
+    (name,value) pairs, see :func:`_collect_attribs`.
+    '''
     retdict = {}
-    els = var(text=False)
-    varcnt = 0
-    retdict['ID'] = var.get('ID', var['name'])
+    els = var.iterdescendants(etree.Element)
+    retdict['ID'] = var.get('ID', var.get('name'))
     for var in els:
-        if var.name in ('catValu', 'catStat', 'qstn', 'catgry'):
+        # <range> and <item> are read with their <valrng> and <invalrng>
+        if var.tag in ('catValu', 'catStat', 'qstn', 'catgry', 'range',
+                       'item'):
             continue
-        if var.name == 'qstn':
-            valstr = var.preQTxt.string.strip() if var.preQTxt.string else None
-            retdict['preQTxt'] = valstr
-            valstr = var.qstnLit.string.strip() if var.qstnLit.string else None
-            retdict['qstnLit'] = valstr
-            valstr = var.postQTxt.string.strip() if var.postQTxt.string else None
-            retdict['postQTxt'] = valstr
-            valstr = var.ivuInstr.string.strip() if var.ivuInstr.string else None
-            retdict['ivuInstr'] = valstr
-        elif var.name.startswith('sumStat'):
-            var.name = "sumStat_%s" % var['type']
-            retdict[var.name] = var.string.strip()
-        elif var.name == 'valrng':
-            retdict['range'] = [("%s,%s" % (k, v) for k, v in var.range.attrs.iteritems())]
-        elif var.name == 'invalrng':
-            if var.item:
-                retdict['item'] = [("%s,%s" % (k, v) for k, v in var.item.attrs.iteritems())]
+        if var.tag == 'qstn':
+            for head in ('preQTxt', 'qstnLit', 'postQTxt', 'ivuInstr'):
+                el = var.find(head)
+                valstr = _string(el) if el is not None else None
+                retdict[head] = valstr.strip() if valstr else None
+        elif var.tag.startswith('sumStat'):
+            retdict["sumStat_%s" % var.get('type')] = _string(var).strip()
+        elif var.tag == 'valrng':
+            rng = var.find('range')
+            retdict['range'] = _collect_attribs(rng)
+        elif var.tag == 'invalrng':
+            item = var.find('item')
+            if item is not None:
+                retdict['item'] = _collect_attribs(item)
         else:
-            if var.name == 'labl' and 'level' in var.attrs:
-                if var['level'] == 'variable' and var.string:
-                    retdict['labl'] = var.string.strip()
+            string = _string(var)
+            if var.tag == 'labl' and 'level' in var.attrib:
+                if var.get('level') == 'variable' and string:
+                    retdict['labl'] = string.strip()
             else:
-                retdict[var.name] = var.string.strip() if var.string else None
+                retdict[var.tag] = string.strip() if string else None
     return retdict
 
 
 def _create_code_rows(var):
     rows = []
-    for cat in var('catgry', text=False, recursive=False):
+    for cat in var.iterchildren('catgry'):
         catdict = {}
-        catdict['ID'] = var['ID'] if 'ID' in var else var['name']
-        catdict['catValu'] = cat.catValu.string if cat.catValu else None
-        catdict['labl'] = cat.labl.string if cat.labl else None
-        catdict['catStat'] = cat.catStat.string if cat.catStat else None
+        catdict['ID'] = var.get('ID', var.get('name'))
+        for head in ('catValu', 'labl', 'catStat'):
+            el = cat.find(head)
+            catdict[head] = _string(el) if el is not None else None
         rows.append(catdict)
     return rows
 
@@ -260,166 +579,336 @@ def _last_statements_to_rewrite():
     pkg.extras['lang_title_0'] = pkg.language  # Guess. Good, I hope.
 
 
-class DataConverter:
+class Conversion(object):
+    '''State of converting one DDI document, see
+    :meth:`DataConverter.convert`.
+
+    :param ddi_xml: root element of the DDI document
+    :type ddi_xml: lxml.etree._Element
+    :param context: CKAN context, 'user' is used if there is no harvest object
+    :type context: dict
+    :param strict: require mandatory metadata fields
+    :type strict: boolean
+    :param original_label: storage label of the saved document
+    :type original_label: string
+    :param owner_org: name of the owner organization
+    :type owner_org: string
+    :param xpath_matcher: parts of the document to flatten, all if None
+    :type xpath_matcher: :class:`ckanext.ddi.flattener.XPathMatcher`
+
+    The document is indexed for the extractors, see :class:`DocumentIndex`.
+    '''
 
-    def __init__(self):
-        self.ddi_xml = None
-        self.context = None
-        self.strict = True
+    def __init__(self, ddi_xml=None, context=None, strict=True,
+                 original_label=None, owner_org=None, xpath_matcher=None):
+        self.ddi_xml = ddi_xml
+        self.context = context
+        self.strict = strict
+        self.original_label = original_label
+        self.owner_org = owner_org
+        self.xpath_matcher = xpath_matcher
+        self.index = DocumentIndex(ddi_xml) if ddi_xml is not None else None
+        # (subject element, keywords, disciplines), see
+        # DataConverter._classify_subject()
+        self.subject_terms = None
+        # (message, line number or None)
         self.errors = []
 
-    def ddi2ckan(self, data, original_url=None, original_xml=None,
-                 harvest_object=None, context=None, strict=True):
-        '''Read DDI2 data and convert it to CKAN format.
+    def add_error(self, message, line=None):
+        '''Record an error of the conversion.
         '''
-        self.ddi_xml = data
-        self.context = context
-        self.strict = strict
+        self.errors.append((message, line))
+
+
+def _conversion_attribute(name):
+    '''Attribute 'name' of the conversion of the calling thread.
+    '''
+    return property(lambda self: getattr(self.conversion, name),
+                    lambda self, value: setattr(self.conversion, name, value))
+
+
+class DataConverter(object):
+    '''Converter of DDI2 documents to CKAN packages.
+
+    One converter can be used by several threads at the same time. The state
+    of a conversion is a :class:`Conversion` of the calling thread, the
+    attributes such as 'ddi_xml' and 'errors' refer to it.
+    '''
+
+    ddi_xml = _conversion_attribute('ddi_xml')
+    context = _conversion_attribute('context')
+    strict = _conversion_attribute('strict')
+    original_label = _conversion_attribute('original_label')
+    owner_org = _conversion_attribute('owner_org')
+    xpath_matcher = _conversion_attribute('xpath_matcher')
+    errors = _conversion_attribute('errors')
+
+    def __init__(self):
+        self._local = threading.local()
+        # Harvest source id -> (harvest job id, owner organization name)
+        self.owner_orgs = {}
+
+    @property
+    def conversion(self):
+        '''The current or last conversion of the calling thread.
+
+        :rtype: :class:`Conversion`
+        '''
+        conversion = getattr(self._local, 'conversion', None)
+        if conversion is None:
+            conversion = self._local.conversion = Conversion()
+        return conversion
+
+    @property
+    def fields(self):
+        '''Compiled XPaths of FIELDS for the calling thread.
+
+        :rtype: dict
+        '''
+        fields = getattr(self._local, 'fields', None)
+        if fields is None:
+            fields = self._local.fields = dict(
+                (field, ([etree.XPath(xpath, smart_strings=False)
+                          for xpath in xpaths], mandatory))
+                for field, (xpaths, mandatory) in FIELDS.iteritems())
+        return fields
+
+    def convert(self, data, original_url=None, original_xml=None,
+                harvest_object=None, context=None, strict=True,
+                original_label=None, owner_org=None, xpath_matcher=None):
+        '''Read DDI2 data and convert it to CKAN format. Safe to call from
+        several threads at the same time.
+
+        :param data: root element of the DDI document, see :func:`parse_ddi`
+        :type data: lxml.etree._Element
+        :param original_label: storage label of 'original_xml' if it is
+            already saved, see :func:`store_document`
+        :type original_label: string
+        :param owner_org: name of the owner organization, looked up for
+            'harvest_object' if not given
+        :type owner_org: string
+        :param xpath_matcher: parts of docDscr and stdyDscr to flatten to
+            'xpaths', all if None
+        :type xpath_matcher: :class:`ckanext.ddi.flattener.XPathMatcher`
+        :returns: package dictionary or False, and the errors of the
+            conversion as (message, line number or None) tuples
+        :rtype: tuple
+        '''
+        conversion = self._local.conversion = Conversion(
+            data, context, strict, original_label, owner_org, xpath_matcher)
         try:
-            return self._ddi2ckan(original_url, original_xml, harvest_object)
+            package_dict = self._ddi2ckan(original_url, original_xml,
+                                          harvest_object)
         except Exception as e:
             log.debug(traceback.format_exc(e))
-        return False
+            package_dict = False
+        return package_dict, conversion.errors
 
-    def _read_value(self, bs_eval_string, default=u'', mandatory_field=False):
+    def ddi2ckan(self, data, original_url=None, original_xml=None,
+                 harvest_object=None, context=None, strict=True,
+                 original_label=None, owner_org=None, xpath_matcher=None):
+        '''Read DDI2 data and convert it to CKAN format. The errors are
+        available from :meth:`get_errors` until the next conversion in the
+        same thread. See :meth:`convert` for the parameters.
         '''
-        Evaluate values from Beautiful Soup objects.
-        Returns default if evaluation failed, else return the evaluated output.
+        return self.convert(data, original_url, original_xml, harvest_object,
+                            context, strict, original_label, owner_org,
+                            xpath_matcher)[0]
+
+    def get_owner_org(self, harvest_object):
+        '''Return the name of the organization owning the harvest source of
+        'harvest_object'. The name is looked up once per harvest job.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :rtype: string
         '''
-        # Make sure we are using class variables
-        eval_string = bs_eval_string if bs_eval_string.startswith('self.') \
-            else 'self.' + bs_eval_string
-        try:
-            output = eval(eval_string)
-            return output
-        except (AttributeError, TypeError):
-            if mandatory_field and self.strict:
-                log.debug('Unable to read mandatory value: {path}'
-                          .format(path=bs_eval_string))
-                self.errors.append('Unable to read mandatory value: {path}'
-                                   .format(path=bs_eval_string))
-            else:
-                log.debug('Unable to read optional value: {path}'
-                          .format(path=bs_eval_string))
-            return default
+        hsid = harvest_object.harvest_source_id
+        job_id, owner_org = self.owner_orgs.get(hsid, (None, None))
+        if owner_org is None or job_id != harvest_object.harvest_job_id:
+            owner_org = model.Session.query(model.Group.name) \
+                .join(model.Package, model.Package.owner_org == model.Group.id) \
+                .filter(model.Package.id == hsid).one()[0]
+            self.owner_orgs[hsid] = (harvest_object.harvest_job_id, owner_org)
+        return owner_org
+
+    def _find_all(self, start_tag, *names, **attrs):
+        '''Find descendants of 'start_tag' like :func:`_find_all`, using the
+        index of the document being converted when possible.
+        '''
+        index = self.conversion.index
+        if index is not None and len(names) == 1 and \
+                index.covers(start_tag, names[0]):
+            return index.find_all(start_tag, names[0], **attrs)
+        return _find_all(start_tag, *names, **attrs)
+
+    def _read_value(self, field, default=u''):
+        '''
+        Read a metadata field (see FIELDS) from the DDI document using the
+        compiled XPaths of the field in order of preference.
+        Returns default if nothing was found, else return the first found
+        output: a list of elements or a string.
+        '''
+        xpaths, mandatory_field = self.fields[field]
+        for xpath in xpaths:
+            output = xpath(self.ddi_xml)
+            if output:
+                return output
+        if mandatory_field and self.strict:
+            log.debug('Unable to read mandatory value: {field}'
+                      .format(field=field))
+            self.conversion.add_error('Unable to read mandatory value: '
+                                      '{field}'.format(field=field))
+        else:
+            log.debug('Unable to read optional value: {field}'
+                      .format(field=field))
+        return default
 
 
     def empty_errors(self):
-        '''Remove errors of the instance.
+        '''Remove errors of the last conversion of the calling thread.
         '''
         self.errors = []
 
     def get_errors(self):
         '''
-        Return errors found in instance's data parsing.
+        Return errors found in the last conversion of the calling thread as
+        (message, line number or None) tuples.
         '''
         return self.errors
 
-    @ExceptReturn(AttributeError)
-    def get_clean_date(self, bs4_element):
-        raw_date = DATE_REGEX.search(bs4_element.get('date'))
+    @ExceptReturn(AttributeError, field='date')
+    def get_clean_date(self, element):
+        raw_date = DATE_REGEX.search(element.get('date'))
         return raw_date.group(0).rstrip('-') if raw_date and \
                                                 raw_date.group(0) else ''
 
     @ExceptReturn((AttributeError, TypeError, UserWarning, IndexError),
                   mandatory_field=True)
-    def get_attrdate_mandatory(self, start_bs4tag, *args, **kwargs):
+    def get_attrdate_mandatory(self, start_tag, *args, **kwargs):
         # TODO: this is obsolete, more general see: get_attr_mandatory()
-        ''''Search BeautifulSoup object for a tag and return its date attribute.
+        ''''Search an element for a tag and return its date attribute.
 
-        Search beginning from start_bs4tag with *args and **kwargs. Remove found
-        tags from ddi xml with extract(). Assure that no empty tags fail. Remove
-        in-keyword-commas.
+        Search beginning from start_tag with *args and **kwargs. Assure that no
+        empty tags fail.
 
-        :param start_bs4tag: bs4 tag to start search
-        :type start_bs4tag: bs4.element.Tag instance
-        :returns: a string of comma separated keywords
+        :param start_tag: element to start search
+        :type start_tag: lxml.etree._Element
+        :returns: a date string
         :rtype: a string
         '''
-        result_set = start_bs4tag(args, kwargs)
+        result_set = self._find_all(start_tag, *args, **kwargs)
         if len(result_set) > 1:
             warnings.simplefilter('error', UserWarning)  # raises warning
             warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
+                tag=result_set[0].tag))
         return self.get_clean_date(result_set[0])
 
     @ExceptReturn((AttributeError, TypeError, UserWarning))
-    def get_attrdate_optional(self, start_bs4tag, *args, **kwargs):
-        '''Search BeautifulSoup object for a tag and return its date attribute.
+    def get_attrdate_optional(self, start_tag, *args, **kwargs):
+        '''Search an element for a tag and return its date attribute.
 
         Optional version. see. get_attrdate_mandatory
         '''
-        result_set = start_bs4tag(args, kwargs)
+        result_set = self._find_all(start_tag, *args, **kwargs)
         if len(result_set) > 1:
             warnings.simplefilter('error', UserWarning)  # raises warning
             warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
+                tag=result_set[0].tag))
         return self.get_clean_date(result_set[0]) if result_set else ''
 
     @ExceptReturn((AttributeError, TypeError, KeyError, UserWarning), mandatory_field=True)
-    def get_attr_mandatory(self, start_bs4tag, search_tag, attr):
-        '''Return the value of an attribute of a BeautifulSoup tag.
+    def get_attr_mandatory(self, start_tag, search_tag, attr):
+        '''Return the value of an attribute of a tag.
         '''
-        result_set = start_bs4tag(search_tag)
+        result_set = self._find_all(start_tag, search_tag)
         if len(result_set) > 1:
             warnings.simplefilter('error', UserWarning)  # To raise as exception
             warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
+                tag=result_set[0].tag))
         # Strange 'else' statement is to trigger exception
-        return result_set[0][attr] if result_set else result_set[attr]
+        return result_set[0].attrib[attr] if result_set else result_set[attr]
 
     @ExceptReturn((AttributeError, TypeError, KeyError))
-    def get_attr_optional(self, start_bs4tag, search_tag, attr):
-        result_set = start_bs4tag(search_tag)
+    def get_attr_optional(self, start_tag, search_tag, attr):
+        result_set = self._find_all(start_tag, search_tag)
         if len(result_set) > 1:
             warnings.simplefilter('error', UserWarning)  # To raise as exception
             warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
+                tag=result_set[0].tag))
         # Strange 'else' statement is to trigger exception
-        return result_set[0][attr] if result_set else result_set[attr]
+        return result_set[0].attrib[attr] if result_set else result_set[attr]
 
     # Authors & organizations
-    @ExceptReturn((AttributeError, TypeError), mandatory_field=True)
-    def get_authors(self, start_bs4tag, search_tag='AuthEnty'):
-        result_set = start_bs4tag(search_tag)
+    @ExceptReturn((AttributeError, TypeError), mandatory_field=True,
+                  field='authors')
+    def get_authors(self, start_tag, search_tag='AuthEnty'):
+        result_set = self._find_all(start_tag, search_tag)
         # TODO Prevent / filter duplicate authors.
         authors = []
         for tag in result_set:
             authors.append({'role': 'author',
-                            # TODO: use extract() to remove tag
-                            'name': tag.text.strip(),
+                            'name': _text(tag).strip(),
                             'organisation': tag.get('affiliation', '')})
         return authors
 
-    @ExceptReturn((AttributeError, TypeError))
-    def get_contributors(self, start_bs4tag, search_tag='othId'):
-        result_set = start_bs4tag(search_tag)
+    @ExceptReturn((AttributeError, TypeError), field='contributors')
+    def get_contributors(self, start_tag, search_tag='othId'):
+        result_set = self._find_all(start_tag, search_tag)
         contributors = []
         for tag in result_set:
             contributors.append({'role': 'contributor',
-                            # TODO: use extract() to remove tag
-                            'name': tag.text.strip(),
+                            'name': _text(tag).strip(),
                             'organisation': tag.get('affiliation', '')})
         return contributors
 
-    @ExceptReturn((AttributeError, TypeError), mandatory_field=True)
-    def get_keywords(self, start_bs4tag):
-        return self.search_tag_content(start_bs4tag, vocab=KW_VOCAB_REGEX)
-
-    @ExceptReturn((AttributeError, TypeError))
-    def get_discipline(self, start_bs4tag):
-        return self.search_tag_content(start_bs4tag, 'topcClas', vocab='FSD')
-
-    def search_tag_content(self, start_bs4tag, *args, **kwargs):
+    @ExceptReturn((AttributeError, TypeError), mandatory_field=True,
+                  field='keywords')
+    def get_keywords(self, start_tag):
+        return ','.join([s for s in self._classify_subject(start_tag)[0] if s])
+
+    @ExceptReturn((AttributeError, TypeError), field='discipline')
+    def get_discipline(self, start_tag):
+        return ','.join([s for s in self._classify_subject(start_tag)[1] if s])
+
+    def _classify_subject(self, start_tag):
+        '''Sort the terms of a subject element (stdyInfo/subject) in one
+        pass: topic classes of the FSD vocabulary are disciplines, terms of
+        other vocabularies are keywords. The pass is done once per subject
+        element in a conversion.
+
+        :param start_tag: the subject element
+        :type start_tag: lxml.etree._Element
+        :returns: keywords and disciplines in document order
+        :rtype: tuple of lists of strings
+        '''
+        conversion = self.conversion
+        terms = conversion.subject_terms
+        if terms is None or terms[0] is not start_tag:
+            keywords = []
+            disciplines = []
+            for tag in start_tag.iterdescendants(etree.Element):
+                vocab = tag.get('vocab')
+                if vocab is None:
+                    continue
+                if tag.tag == 'topcClas' and vocab == 'FSD':
+                    disciplines.append(_text(tag))
+                elif KW_VOCAB_REGEX.search(vocab):
+                    keywords.append(_text(tag))
+            terms = conversion.subject_terms = (start_tag, keywords,
+                                                disciplines)
+        return terms[1:]
+
+    def search_tag_content(self, start_tag, *args, **kwargs):
         '''
-        Search BeautifulSoup object for keywords or alike and return comma
-        separated string of results.
+        Search an element for keywords or alike and return comma separated
+        string of results.
 
-        Search beginning from start_bs4tag with `args` and `kwargs`. Remove found
-        tags from ddi xml with extract(). Assure that no empty tags fail.
+        Search beginning from start_tag with `args` and `kwargs`. Assure that
+        no empty tags fail.
 
-        :param start_bs4tag: bs4 tag to start search
-        :type start_bs4tag: bs4.element.Tag instance
+        :param start_tag: element to start search
+        :type start_tag: lxml.etree._Element
         :param args: searched tag (only one supported) or none
         :type args: one string or None
         :param kwargs: searched attributes of a ddi tag
@@ -427,26 +916,26 @@ class DataConverter:
         :returns: a string of comma separated keywords
         :rtype: a string
         '''
-        result_set = start_bs4tag(args, kwargs)
-        strings = [ tag.extract().string for tag in result_set ]
+        result_set = self._find_all(start_tag, *args, **kwargs)
+        strings = [ _text(tag) for tag in result_set ]
         kw_string = ','.join([ s for s in strings if s ])
         return kw_string
 
-    def _get_events(self, stdy_dscr, authors):
+    def _get_events(self, authors):
         '''
         Parse data into events from DDI fields
         '''
         events = []
 
         # Event: Collection
-        ev_type_collect = self._read_value(stdy_dscr + ".stdyInfo.sumDscr('collDate', event='start')")
-        data_collector = self._read_value(stdy_dscr + ".method.dataColl('dataCollector')")
+        ev_type_collect = self._read_value('collection_dates')
+        data_collector = self._read_value('data_collectors')
         data_coll_string = u''
         for d in data_collector:
-            if d.text:
-                data_coll_string += '; ' + (d.text)
-            elif d['affiliation']:  # This is ok because d is BeautifulSoup object
-                data_coll_string += '; ' + (d['affiliation'])
+            if _text(d):
+                data_coll_string += '; ' + _text(d)
+            elif d.get('affiliation'):
+                data_coll_string += '; ' + d.get('affiliation')
         data_coll_string = data_coll_string[2:]
         for collection in ev_type_collect:
             events.append({'descr': u'Event automatically created at import.',
@@ -455,7 +944,7 @@ class DataConverter:
                            'who': data_coll_string})
 
         # Event: Creation (eg. Published in publication)
-        ev_type_create = self._read_value(stdy_dscr + ".citation.prodStmt('prodDate')")
+        ev_type_create = self._read_value('production_dates')
         if ev_type_create:
             data_creators = [ a.get('name') or a.get('organisation') for a in authors ]
             data_creator_string = '; '.join(data_creators)
@@ -467,35 +956,31 @@ class DataConverter:
 
         return events
 
-    @ExceptReturn((AttributeError, TypeError))
-    def get_geo_coverage(self, start_bs4tag):
+    @ExceptReturn((AttributeError, TypeError), field='geographic_coverage')
+    def get_geo_coverage(self, start_tag):
         '''Return a string of comma separated locations.
 
-        Removes matched tags from ddi xml with extract().
-
         >>> self.get_geo_coverage(self.ddi_xml)
             u'Espoo,Keilaniemi'
         '''
-        geog_lcs = start_bs4tag('geogCover')
-        geog_string = ','.join([ loc.extract().string for loc in geog_lcs ])
+        geog_lcs = self._find_all(start_tag, 'geogCover')
+        geog_string = ','.join([ _text(loc) for loc in geog_lcs ])
         return geog_string
 
-    @ExceptReturn((AttributeError, TypeError))
-    def get_temporal_coverage(self, start_bs4tag):
+    @ExceptReturn((AttributeError, TypeError), field='temporal_coverage')
+    def get_temporal_coverage(self, start_tag):
         '''Return the beginning and ending date of a time period covered by
         dataset.
-
-        Removes matched tags from ddi xml with extract().
         '''
         t_begin = t_end = u''
-        time_prds = start_bs4tag('timePrd')
+        time_prds = self._find_all(start_tag, 'timePrd')
         for t in time_prds:
-            clean_date = self.get_clean_date(t.extract())
-            if t.attrs['event'] == 'single':
+            clean_date = self.get_clean_date(t)
+            if t.attrib['event'] == 'single':
                 t_begin = t_end = clean_date
-            if t.attrs['event'] == 'start':
+            if t.attrib['event'] == 'start':
                 t_begin = clean_date
-            if t.attrs['event'] == 'end':
+            if t.attrib['event'] == 'end':
                 t_end = clean_date
         return t_begin, t_end
 
@@ -511,13 +996,16 @@ class DataConverter:
             log.debug('Invalid language: {ke}'.format(ke=ke))
             return ''
 
-    @ExceptReturn(UnicodeEncodeError, mandatory_field=True)
-    def _save_original_xml(self, original_xml, name, harvest_object=None):
+    @ExceptReturn(UnicodeEncodeError, mandatory_field=True,
+                  field='original_xml')
+    def _save_original_xml(self, original_xml, name, harvest_object=None,
+                           digest=None):
         ''' Here is created a ofs storage ie. local pairtree storage for
         objects/blobs. The original xml is saved to this storage in
         <harvest_source_id> (or <c.user>) named folder. NOTE: The content of
-        this folder is overwritten at reharvest. We assume that if metadata is
-        re-parsed also xml is changed. So old xml can be overwritten.
+        this folder is overwritten at reharvest if the xml has changed. The
+        SHA-1 'digest' of the xml is kept in the metadata of the stored file
+        and an identical file is not written again.
 
         Example::
 
@@ -531,20 +1019,25 @@ class DataConverter:
             dir = self.context['user']
         label = '{directory}/{filename}.xml'.format(directory=dir,
                                                     filename=name)
+        digest = digest or content_hash(original_xml)
         try:
             ofs = storage.get_ofs()
-            ofs.put_stream(storage.BUCKET, label, original_xml, {})
-            fileurl = config.get('ckan.site_url') + h.url_for('storage_file',
-                                                              label=label)
+            if ofs.exists(storage.BUCKET, label) and \
+                    ofs.get_metadata(storage.BUCKET, label).get('sha1') == digest:
+                log.debug('Original xml not changed: {la}'.format(la=label))
+            else:
+                ofs.put_stream(storage.BUCKET, label, original_xml,
+                               {'sha1': digest})
+            fileurl = storage_url(label)
         except IOError, ioe:
             log.debug('Unable to save original xml to: {sto}, {io}'.format(
                 sto=storage.BUCKET, io=ioe))
-            self.errors.append('Unable to save original xml: {io}'.format(
-                io=ioe))
+            self.conversion.add_error('Unable to save original xml: {io}'
+                                      .format(io=ioe))
             return u''
         return fileurl
 
-    def _save_ddi_variables_to_csv(self, name, pkg, harvest_object):
+    def _save_ddi_variables_to_csv(self, original_xml, name, harvest_object):
         # JuhoL: Handle codeBook.dataDscr parts, extract data (eg. questionnaire)
         # variables etc.
         # Saves <var>...</var> elements to a csv file accessible at:
@@ -552,80 +1045,74 @@ class DataConverter:
         # And separately saves <catgry> elements inside <var> to a csv as a resource
         # for package.
         # Assumes that dataDscr has not changed. Valid?
-        data_dscr = "ddi_xml.codeBook.dataDscr"
+        # The variables are read from 'original_xml' with iterparse instead of
+        # the parsed tree, as codebooks may have tens of thousands of them.
+        # Not called by the harvester yet, see _ddi2ckan.
         try:
             ofs = storage.get_ofs()
         except IOError, ioe:
             log.debug('Unable to save xml variables: {io}'.format(io=ioe))
-            self.errors.append('Unable to save xml variables: {io}'.format(io=ioe))
+            self.conversion.add_error('Unable to save xml variables: {io}'
+                                      .format(io=ioe))
             return u''
 
-        ddi_vars = self._read_value(data_dscr + "('var')")  # Find all <var> elements
         heads = _get_headers()
         c_heads = ['ID', 'catValu', 'labl', 'catStat']
-        f_var = StringIO.StringIO()
-        c_var = StringIO.StringIO()
-        varwriter = csv.DictWriter(f_var, heads)
-        codewriter = csv.DictWriter(c_var, c_heads)
-        heading_row = {}
-        for head in heads:
-            heading_row[head] = head
-        c_heading_row = {}
-        for head in c_heads:
-            c_heading_row[head] = head
-        varwriter.writerow(heading_row)
-        codewriter.writerow(c_heading_row)
-        for var in ddi_vars:
+        f_var = tempfile.SpooledTemporaryFile(CSV_SPOOL_SIZE)
+        c_var = tempfile.SpooledTemporaryFile(CSV_SPOOL_SIZE)
+        try:
+            varwriter = csv.DictWriter(f_var, heads)
+            codewriter = csv.DictWriter(c_var, c_heads)
+            varwriter.writerow(dict(zip(heads, heads)))
+            codewriter.writerow(dict(zip(c_heads, c_heads)))
+            # Rows are written as each <var> closes, so memory use does not
+            # depend on the number of variables.
             try:
-                varwriter.writerow(_construct_csv(var, heads))
-                codewriter.writerows(_create_code_rows(var))
-            except ValueError, e:
+                for var in _iter_ddi_vars(original_xml):
+                    varwriter.writerow(_construct_csv(var, heads))
+                    codewriter.writerows(_create_code_rows(var))
+            except (ValueError, etree.XMLSyntaxError), e:
                 # Assumes that the process failed. Room for retry?
                 raise IOError("Failed to import DDI to CSV! %s" % e)
-        f_var.flush()
-        label = '{dir}/{filename}_var.csv'.format(
-            dir=harvest_object.harvest_source_id, filename=name)
-        ofs.put_stream(storage.BUCKET, label, f_var, {})
-        fileurl_var = config.get('ckan.site_url') + h.url_for('storage_file',
-                                                          label=label)
-        #pkg.add_resource(url=fileurl,
-        #                 description="Variable metadata",
-        #                 format="csv",
-        #                 size=f_var.len)
-
-        label = '{dir}/{filename}_code.csv'.format(
-            dir=harvest_object.harvest_source_id, filename=name)
-        ofs.put_stream(storage.BUCKET, label, c_var, {})
+            f_var.seek(0)
+            label = '{dir}/{filename}_var.csv'.format(
+                dir=harvest_object.harvest_source_id, filename=name)
+            ofs.put_stream(storage.BUCKET, label, f_var, {})
+            fileurl_var = config.get('ckan.site_url') + h.url_for('storage_file',
+                                                              label=label)
+            #pkg.add_resource(url=fileurl,
+            #                 description="Variable metadata",
+            #                 format="csv",
+            #                 size=f_var.tell())
+
+            c_var.seek(0)
+            label = '{dir}/{filename}_code.csv'.format(
+                dir=harvest_object.harvest_source_id, filename=name)
+            ofs.put_stream(storage.BUCKET, label, c_var, {})
+        finally:
+            f_var.close()
+            c_var.close()
         fileurl_code = config.get('ckan.site_url') + h.url_for('storage_file',
                                                           label=label)
         #pkg.add_resource(url=fileurl,
         #                 description="Variable code values",
         #                 format="csv",
-        #                 size=c_var.len)
+        #                 size=c_var.tell())
         # JuhoL: Append labels of variables ('questions') also to metas
-        # TODO: change to return XPath dict of labels
-        flattened_var_labels = {}
-        f_var.seek(0)  # JuhoL: Set 'read cursor' to row 0
-        reader = csv.DictReader(f_var)
-        #for var in reader:
-        #    metas.append(var['labl'] if 'labl' in var else var['qstnLit'])
-        # TODO: return flattened_var_labels
+        # TODO: return XPath dict of labels
         return fileurl_var, fileurl_code
 
     def _ddi2ckan(self, original_url, original_xml, harvest_object):
-        '''Extract package values from bs4 object 'ddi_xml' parsed from xml
+        '''Extract package values from lxml tree 'ddi_xml' parsed from xml
         '''
-        # TODO: Use .extract() and .string.extract() function so handled elements are removed from ddi_xml.
-        doc_citation = "ddi_xml.codeBook.docDscr.citation"
-        stdy_dscr = "ddi_xml.codeBook.stdyDscr"
 
         ####################################################################
         #      Read mandatory metadata fields:                             #
         ####################################################################
         # Authors & organizations
-        authors = self.get_authors(self.ddi_xml.stdyDscr.citation, 'AuthEnty')
+        authors = self.get_authors(self.ddi_xml.find('stdyDscr/citation'), 'AuthEnty')
         agent = authors[:]
-        agent.extend(self.get_contributors(self.ddi_xml.stdyDscr.citation))
+        agent.extend(self.get_contributors(self.ddi_xml.find('stdyDscr/citation')))
 
         # Availability
         availability = AVAILABILITY_DEFAULT
@@ -635,56 +1122,51 @@ class DataConverter:
             availability = AVAILABILITY_FSD
 
         # Keywords
-        keywords = self.get_keywords(self.ddi_xml.stdyDscr.stdyInfo.subject)
+        keywords = self.get_keywords(self.ddi_xml.find('stdyDscr/stdyInfo/subject'))
 
         # Language
         # TODO: Where/how to extract multiple languages: 'language': u'eng, fin, swe' ?
         language = self.convert_language(
-            self._read_value("ddi_xml.codeBook.get('xml:lang')"))
+            self._read_value('language'))
 
         # Titles
-        titles = self._read_value(stdy_dscr + ".citation.titlStmt(['titl', 'parTitl'])") or \
-            self._read_value(doc_citation + ".titlStmt(['titl', 'parTitl'])", mandatory_field=True)
-        langtitle=[dict(lang=self.convert_language(a.get('xml:lang', '')), value=a.text) for a in titles]
-        #langtitle=[dict(lang='fin', value=a.text) for a in titles]
+        titles = self._read_value('titles')
+        langtitle=[dict(lang=self.convert_language(a.get(XML_LANG, '')), value=_text(a)) for a in titles]
+        #langtitle=[dict(lang='fin', value=_text(a)) for a in titles]
 
         # License
         # TODO: Extract prettier output. Should we check that element contains something?
         # Should this be in optional section if not mandatory_field?
-        license_url = self._read_value(stdy_dscr + ".dataAccs.useStmt.get_text(separator=u' ')", mandatory_field=False)
+        license_url = self._read_value('license')
+        if license_url:
+            license_url = _get_text(license_url[0], separator=u' ')
         if _is_fsd(original_url):
             license_id = LICENCE_ID_FSD
         else:
             license_id = LICENCE_ID_DEFAULT
 
         # Contact (package_extra.key: contact_[k]_name in database, contact in WUI)
-        contact_name = self._read_value(stdy_dscr + ".citation.distStmt('contact')") or \
-                     self._read_value(stdy_dscr + ".citation.distStmt('distrbtr')") or \
-                     self._read_value(doc_citation + ".prodStmt('producer')", mandatory_field=True)
+        contact_name = self._read_value('contact_names')
         # TODO: clean out (or ask FSD to clean) mid text newlines (eg. in FSD2482)
-        if contact_name and contact_name[0].text:
-            contact_name = contact_name[0].text
+        if contact_name and _text(contact_name[0]):
+            contact_name = _text(contact_name[0])
         else:
-            contact_name = self._read_value(stdy_dscr + ".citation.prodStmt.producer.get('affiliation')", mandatory_field=True)
+            contact_name = self._read_value('contact_affiliation')
         if _is_fsd(original_url):
             contact_email = CONTACT_EMAIL_FSD
             # TODO: Allow trying other email also in FSD metadata
         else:
-            contact_email = self._read_value(stdy_dscr + ".citation.distStmt.contact.get('email')", mandatory_field=True)
+            contact_email = self._read_value('contact_email')
 
         # Modified date
-        version = self.get_attr_optional(self.ddi_xml.stdyDscr.citation,
+        version = self.get_attr_optional(self.ddi_xml.find('stdyDscr/citation'),
                                          'prodDate', 'date') or \
-                  self.get_attr_mandatory(self.ddi_xml.stdyDscr.citation,
+                  self.get_attr_mandatory(self.ddi_xml.find('stdyDscr/citation'),
                                           'version', 'date')
 
         # Name
-        name_prefix = self._read_value(stdy_dscr + ".citation.titlStmt.IDNo.get('agency')", mandatory_field=False)
-        name_id = self._read_value(stdy_dscr + ".citation.titlStmt.IDNo.text", mandatory_field=False)
-        if not name_prefix:
-            name_prefix = self._read_value(doc_citation + ".titlStmt.IDNo['agency']", mandatory_field=True)
-        if not name_id:
-            name_id = self._read_value(doc_citation + ".titlStmt.IDNo.text", mandatory_field=True)
+        name_prefix = self._read_value('name_prefix')
+        name_id = self._read_value('name_id')
         name = utils.datapid_to_name(name_prefix + name_id)
 
         pids = list()
@@ -695,9 +1177,15 @@ class DataConverter:
         # pids.append({'id': vpid, 'type': 'version', 'provider': 'kata'})
 
         # Original xml and web page as resource
-        orig_xml_storage_url = self._save_original_xml(original_xml, name, harvest_object)
+        orig_xml_hash = content_hash(original_xml)
+        if self.original_label:
+            # Saved already in the fetch stage
+            orig_xml_storage_url = storage_url(self.original_label)
+        else:
+            orig_xml_storage_url = self._save_original_xml(
+                original_xml, name, harvest_object, orig_xml_hash)
         # For FSD 'URI' leads to summary web page of data, hence format='html'
-        orig_web_page = self._read_value(doc_citation + ".holdings.get('URI', '')")
+        orig_web_page = self._read_value('orig_web_page')
         if orig_web_page:
             orig_web_page_resource = {'description': langtitle[0].get('value'),
                                       'format': u'html',
@@ -707,17 +1195,15 @@ class DataConverter:
             orig_web_page_resource = {}
 
         # Owner
-        owner = self._read_value(stdy_dscr + ".citation.prodStmt.producer.text") or \
-                self._read_value(stdy_dscr + ".citation.rspStmt.AuthEnty.text") or \
-                self._read_value(doc_citation + ".prodStmt.producer.string", mandatory_field=True)
+        owner = self._read_value('owner')
         agent.append({'role': 'owner',
                       'name': owner})
 
         # Owner organisation
-        if harvest_object:
-            hsid = harvest_object.harvest_source_id
-            hsooid = model.Session.query(model.Package).filter(model.Package.id==hsid).one().owner_org
-            owner_org = model.Session.query(model.Group).filter(model.Group.id==hsooid).one().name
+        if self.owner_org is not None:
+            owner_org = self.owner_org
+        elif harvest_object:
+            owner_org = self.get_owner_org(harvest_object)
         else:
             owner_org = u''
 
@@ -736,27 +1222,22 @@ class DataConverter:
             access_request_url = u''
 
         # Contact
-        contact_phone = self._read_value(doc_citation + ".holdings.get('callno')") or \
-                        self._read_value(stdy_dscr + ".citation.holdings.get('callno')")
+        contact_phone = self._read_value('contact_phone')
 
-        contact_URL = self._read_value( stdy_dscr + ".dataAccs.setAvail.accsPlac.get('URI')") or \
-                      self._read_value( stdy_dscr + ".citation.distStmt.contact.get('URI')") or \
-                      self._read_value( stdy_dscr + ".citation.distStmt.distrbtr.get('URI')") or \
+        contact_URL = self._read_value('contact_URL') or \
                       CONTACT_URL_FSD if _is_fsd(original_url) else None
 
         # Description
-        description_array = self._read_value(stdy_dscr + ".stdyInfo.abstract('p')")
-        if not description_array:
-            description_array = self._read_value(stdy_dscr + ".citation.serStmt.serInfo('p')")
+        description_array = self._read_value('description')
 
-        notes = '\r\n\r\n'.join([description.string for
+        notes = '\r\n\r\n'.join([_text(description) for
                                  description in description_array])
 
         # Discipline
-        discipline = self.get_discipline(self.ddi_xml.stdyDscr.stdyInfo.subject)
+        discipline = self.get_discipline(self.ddi_xml.find('stdyDscr/stdyInfo/subject'))
 
         # Dataset lifetime events
-        events = self._get_events(stdy_dscr, authors)
+        events = self._get_events(authors)
 
         # Geographic coverage
         geo_cover = self.get_geo_coverage(self.ddi_xml)
@@ -768,11 +1249,12 @@ class DataConverter:
         ####################################################################
         #      Flatten rest to 'XPath/path/to/element': 'value' pairs      #
         ####################################################################
-        etree_xml = etree.fromstring(str(self.ddi_xml))
-        flattened_ddi = importcore.generic_xml_metadata_reader(etree_xml.find('.//{*}docDscr'))
-        xpath_dict = flattened_ddi.getMap()
-        flattened_ddi = importcore.generic_xml_metadata_reader(etree_xml.find('.//{*}stdyDscr'))
-        xpath_dict.update(flattened_ddi.getMap())
+        if self.xpath_matcher is not None:
+            flatten = self.xpath_matcher.flatten
+        else:
+            flatten = flattener.flatten
+        xpath_dict = flatten(self.ddi_xml.find('.//docDscr'))
+        flatten(self.ddi_xml.find('.//stdyDscr'), xpath_dict)
 
 
         package_dict = dict(
@@ -801,10 +1283,10 @@ class DataConverter:
             notes=notes or u'',
             pids=pids,
             owner_org=owner_org,
-            resources=[{'algorithm': u'',
+            resources=[{'algorithm': u'sha1',
                         'description': u'Original metadata record',
                         'format': u'xml',
-                        'hash': u'',
+                        'hash': orig_xml_hash,
                         'resource_type': 'file.harvest',
                         'size': len(original_xml),
                         'url': orig_xml_storage_url},
@@ -826,7 +1308,7 @@ class DataConverter:
         #                'Uskon asia: nuorisobarometri 2006 (2006).'},
         #               {'stdyD...': 'Some value'}]
         # }
-        #package_dict['extras'].update(_save_ddi_variables_to_csv(ddi_xml, somepkg))
+        #package_dict['extras'].update(self._save_ddi_variables_to_csv(original_xml, name, harvest_object))
 
 
         # Vanhojen koodien järjestys:
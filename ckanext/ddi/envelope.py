@@ -0,0 +1,57 @@
+# coding: utf-8
+'''
+Compact envelope for fetched DDI documents in harvest object content
+'''
+
+import base64
+import json
+import pickle
+import zlib
+
+
+# Content starting with PREFIX is an envelope, anything else is a pickled
+# dict written by older versions of the harvester.
+PREFIX = 'ddienv:'
+VERSION = 1
+COMPRESS_LEVEL = 6
+
+
+def encode(url, xml, **meta):
+    '''Pack a fetched document to a compressed, text-safe string for
+    HarvestObject.content.
+
+    :param url: URL of the document
+    :type url: string
+    :param xml: the document, empty if it is stored elsewhere
+    :type xml: string
+    :param meta: fetch metadata such as response headers, must be JSON
+    :returns: the envelope
+    :rtype: string
+    '''
+    header = dict(meta, url=url, unicode=isinstance(xml, unicode))
+    if header['unicode']:
+        xml = xml.encode('utf-8')
+    payload = zlib.compress(json.dumps(header) + '\n' + xml, COMPRESS_LEVEL)
+    return '{pr}{ve}:{pa}'.format(pr=PREFIX, ve=VERSION,
+                                  pa=base64.b64encode(payload))
+
+
+def decode(content):
+    '''Unpack harvest object content written by :func:`encode` or pickled by
+    older versions of the harvester.
+
+    :param content: harvest object content
+    :type content: string
+    :returns: dict with keys 'url' and 'xml' and fetch metadata
+    :rtype: dict
+    :raises ValueError: if the envelope version is unknown
+    '''
+    if not content.startswith(PREFIX):
+        return pickle.loads(content)
+    version, _, payload = content[len(PREFIX):].partition(':')
+    if version != str(VERSION):
+        raise ValueError('Unknown envelope version: {ve}'.format(ve=version))
+    header, _, xml = zlib.decompress(base64.b64decode(payload)).partition('\n')
+    info = json.loads(header)
+    info['xml'] = xml.decode('utf-8') if info.pop('unicode') else xml
+    return info
@@ -0,0 +1,252 @@
+# coding: utf-8
+'''
+Flattening of DDI elements to XPath-like keys for package_dict['xpaths']
+'''
+
+import base64
+import collections
+import json
+import zlib
+
+import lxml.etree as etree
+
+
+# Key of the compressed map of flattened xpaths, see pack()
+PACKED_KEY = 'xpaths.zlib'
+# PACKED_KEY in the search index, which leaves out other characters of extra
+# keys than letters, digits, '_' and '-'
+PACKED_INDEX_KEY = 'xpathszlib'
+# Root tags of flattened keys
+SECTIONS = ('docDscr', 'stdyDscr')
+COMPRESS_LEVEL = 6
+
+
+def _local_name(tag):
+    '''Return 'tag' without its namespace.
+    '''
+    if tag[0] == '{':
+        return tag.rsplit('}', 1)[-1]
+    return tag
+
+
+def _intern(path):
+    '''Intern 'path' to share it between documents. Paths with non-ASCII
+    tag names are unicode and are not interned.
+    '''
+    return intern(path) if type(path) is str else path
+
+
+def _add_values(result, path, el):
+    '''Add the text and the attributes of element 'el' at 'path'.
+    '''
+    text = el.text
+    if text and not text.isspace():
+        result[path] = text
+    if el.attrib:
+        for key, value in el.items():
+            result[path + '/@' + _local_name(key)] = value
+
+
+def flatten(element, result=None, path=None):
+    '''Flatten 'element' to a dictionary of XPath-like keys in the format
+    of importcore.generic_xml_metadata_reader() of ckanext-oaipmh, which
+    test_flatten compares it with:
+
+        {'stdyDscr/citation.0/titlStmt.0/titl.0': u'Title',
+         'stdyDscr/citation.0/titlStmt.0/IDNo.0/@agency': u'FSD'}
+
+    Children are numbered per tag name. The descendants are visited in one
+    iteration and the path of an element is built from the path of its
+    parent, so no path is built twice.
+
+    :param element: element to flatten
+    :type element: lxml.etree._Element
+    :param result: dictionary to add the keys to, a new one if None
+    :type result: dict
+    :param path: path of 'element', its tag name if None
+    :type path: string
+    :returns: the flattened element
+    :rtype: dict
+    '''
+    if result is None:
+        result = {}
+    if path is None:
+        path = _intern(_local_name(element.tag))
+    _add_values(result, path, element)
+    # Paths of the visited elements and counts of child tags of the parents
+    paths = {element: path}
+    counts = {}
+    for el in element.iterdescendants(etree.Element):
+        parent = el.getparent()
+        tag = _local_name(el.tag)
+        siblings = counts.get(parent)
+        if siblings is None:
+            siblings = counts[parent] = {}
+        n = siblings.get(tag, 0)
+        siblings[tag] = n + 1
+        path = paths[el] = _intern('%s/%s.%d' % (paths[parent], tag, n))
+        _add_values(result, path, el)
+    return result
+
+
+class _Pattern(object):
+    '''Node of the tree of compiled path prefixes in :class:`XPathMatcher`.
+    '''
+
+    def __init__(self, included=None):
+        # True or False if a prefix ends here, else None
+        self.included = included
+        # Tag name -> _Pattern
+        self.children = {}
+
+
+class XPathMatcher(object):
+    '''Include and exclude prefixes of flattened paths compiled into a tree
+    of tag names, for flattening only parts of a document.
+
+    Prefixes are paths of tag names without the numbering of the keys, for
+    example 'stdyDscr/othrStdyMat'. The longest prefix matching the path of
+    an element decides if it is flattened. If no include prefixes are given,
+    everything not excluded is flattened.
+
+    :param include: path prefixes to flatten
+    :type include: iterable of strings
+    :param exclude: path prefixes not to flatten
+    :type exclude: iterable of strings
+    '''
+
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.root = _Pattern(included=not self.include)
+        for prefixes, included in ((self.include, True),
+                                   (self.exclude, False)):
+            for prefix in prefixes:
+                pattern = self.root
+                for tag in prefix.strip('/').split('/'):
+                    pattern = pattern.children.setdefault(tag, _Pattern())
+                pattern.included = included
+
+    def matches(self, key):
+        '''Check if flattened 'key' is in the parts to flatten.
+
+        :param key: key of a flattened element or attribute
+        :type key: string
+        :rtype: boolean
+        '''
+        pattern = self.root
+        included = pattern.included
+        for n, step in enumerate(key.split('/@', 1)[0].split('/')):
+            # Steps below the root are numbered
+            pattern = pattern.children.get(step.rsplit('.', 1)[0] if n
+                                           else step)
+            if pattern is None:
+                break
+            if pattern.included is not None:
+                included = pattern.included
+        return included
+
+    def flatten(self, element, result=None):
+        '''Flatten the matching parts of 'element' like :func:`flatten`.
+        Subtrees which are not flattened are not walked.
+
+        :param element: element to flatten
+        :type element: lxml.etree._Element
+        :param result: dictionary to add the keys to, a new one if None
+        :type result: dict
+        :returns: the flattened parts of the element
+        :rtype: dict
+        '''
+        if result is None:
+            result = {}
+        tag = _local_name(element.tag)
+        self._flatten(element, _intern(tag), self.root.children.get(tag),
+                      self.root.included, result)
+        return result
+
+    def _flatten(self, element, path, pattern, included, result):
+        '''Flatten 'element' at 'path'. 'pattern' is the node of the path in
+        the prefix tree or None, 'included' the decision of the parent.
+        '''
+        if pattern is not None and pattern.included is not None:
+            included = pattern.included
+        if pattern is None or not pattern.children:
+            # No prefixes below, the whole subtree is decided
+            if included:
+                flatten(element, result, path)
+            return
+        if included:
+            _add_values(result, path, element)
+        counts = {}
+        for child in element.iterchildren(etree.Element):
+            tag = _local_name(child.tag)
+            n = counts.get(tag, 0)
+            counts[tag] = n + 1
+            self._flatten(child, _intern('%s/%s.%d' % (path, tag, n)),
+                          pattern.children.get(tag), included, result)
+
+
+def pack(xpaths, keep=None):
+    '''Pack flattened 'xpaths' into one compressed JSON value for saving as
+    a single package extra. The keys matched by 'keep' are kept as they are
+    as well, to be saved as extras of their own.
+
+    :param xpaths: flattened xpaths
+    :type xpaths: dict
+    :param keep: keys to keep unpacked, none if None
+    :type keep: :class:`XPathMatcher`
+    :returns: the kept keys and the packed map under PACKED_KEY
+    :rtype: dict
+    '''
+    packed = dict((key, value) for key, value in xpaths.iteritems()
+                  if keep is not None and keep.matches(key))
+    packed[PACKED_KEY] = base64.b64encode(zlib.compress(
+        json.dumps(xpaths, sort_keys=True, separators=(',', ':')),
+        COMPRESS_LEVEL))
+    return packed
+
+
+def unpack(value):
+    '''Return the flattened xpaths packed by :func:`pack`.
+
+    :param value: the value of PACKED_KEY
+    :type value: string
+    :rtype: dict
+    '''
+    return json.loads(zlib.decompress(base64.b64decode(value)))
+
+
+class XPaths(collections.Mapping):
+    '''Read-only mapping of the flattened xpaths of a package, stored as
+    separate extras or packed with :func:`pack`. The packed map is decoded
+    on the first access to a key which is not an extra of its own.
+
+    :param extras: extras of the package, a dictionary or a list of
+        dictionaries with 'key' and 'value' as given by package_show
+    :type extras: dict or list
+    '''
+
+    def __init__(self, extras):
+        if not isinstance(extras, dict):
+            extras = dict((extra['key'], extra['value']) for extra in extras)
+        self._packed = extras.get(PACKED_KEY)
+        self._extras = dict((key, value) for key, value in extras.iteritems()
+                            if key.split('/', 1)[0] in SECTIONS)
+        self._xpaths = None
+
+    def _unpacked(self):
+        if self._xpaths is None:
+            self._xpaths = unpack(self._packed) if self._packed \
+                else self._extras
+        return self._xpaths
+
+    def __getitem__(self, key):
+        if key in self._extras:
+            return self._extras[key]
+        return self._unpacked()[key]
+
+    def __iter__(self):
+        return iter(self._unpacked())
+
+    def __len__(self):
+        return len(self._unpacked())
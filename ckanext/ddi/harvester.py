@@ -5,39 +5,222 @@ Harvester for DDI2 formats
 
 #pylint: disable-msg=E1101,E0611,F0401
 import datetime
+import hashlib
 import httplib
 import itertools
 import json
 import logging
 import lxml.etree as etree
-import pickle
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import socket
 import traceback
 import urllib2
 
 
-from bs4 import BeautifulSoup
 from dateutil import parser
+from ckan.logic import get_action
 import ckan.model as model
 from ckanext.harvest.harvesters.base import HarvesterBase
 import ckanext.harvest.model as hmodel
 from ckanext.kata.plugin import KataPlugin
 import dataconverter as dconverter
+import envelope
+import flattener
+import httpclient
+import searchindex
 
 
 log = logging.getLogger(__name__)
 
 socket.setdefaulttimeout(30)
 
+DEFAULT_PROBE_CONCURRENCY = httpclient.DEFAULT_POOL_SIZE
+DEFAULT_GATHER_BATCH_SIZE = 500
+# URLs probed per pool.imap() call for each worker
+PROBE_WINDOW = 100
+# States of harvest objects still to be fetched or imported
+PENDING_STATES = ('WAITING', 'FETCH', 'IMPORT')
+# HTTP cache validators stored as harvest object extras: extra key -> header
+VALIDATORS = (('etag', 'etag'), ('last_modified', 'last-modified'))
+# Extra of harvest objects waiting in the import batch of a process. The
+# harvest consumer marks them complete when import_stage returns, the extra
+# is removed when their package is written.
+QUEUED_EXTRA = 'import_queued'
+# Extra of harvest objects which have left the harvester. The harvest
+# consumer saves the state of an object only after the stage returns.
+DONE_EXTRA = 'stage_done'
+# Extra of harvest objects made current without updating their package
+UNCHANGED_EXTRA = 'package_unchanged'
+
+
+def _get_extra(harvest_object, key):
+    '''Return the value of extra 'key' of 'harvest_object' or None.
+    '''
+    for extra in harvest_object.extras:
+        if extra.key == key:
+            return extra.value
+    return None
+
+
+def _package_fingerprint(package_dict):
+    '''Return a digest of 'package_dict' leaving out the fields that change
+    on every import: the id and the storage details of the original metadata
+    record.
+    '''
+    pkg = dict(package_dict)
+    pkg.pop('id', None)
+    pkg['resources'] = [
+        dict((k, v) for k, v in res.iteritems()
+             if k not in ('url', 'hash', 'size'))
+        if res and res.get('resource_type') == 'file.harvest' else res
+        for res in pkg.get('resources', [])]
+    canonical = json.dumps(pkg, sort_keys=True, separators=(',', ':'),
+                           default=unicode)
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def _xpath_options(config):
+    '''Return the options of flattened xpaths of 'config': the include and
+    exclude prefixes, whether to compress the xpaths and the prefixes of the
+    keys kept as separate extras.
+    '''
+    return (tuple(config.get('xpaths_include', ())),
+            tuple(config.get('xpaths_exclude', ())),
+            config.get('compress_xpaths', False),
+            tuple(config.get('xpaths_whitelist', ())))
+
+
+# (include, exclude) -> compiled XPathMatcher
+_xpath_matchers = {}
+
+
+def _get_xpath_matcher(include=(), exclude=()):
+    '''Return the matcher of the xpath prefixes, compiled once per process,
+    or None if no prefixes are given.
+
+    :param include: path prefixes to match
+    :type include: tuple
+    :param exclude: path prefixes not to match
+    :type exclude: tuple
+    :rtype: :class:`ckanext.ddi.flattener.XPathMatcher`
+    '''
+    if not include and not exclude:
+        return None
+    matcher = _xpath_matchers.get((include, exclude))
+    if matcher is None:
+        matcher = _xpath_matchers[(include, exclude)] = \
+            flattener.XPathMatcher(include, exclude)
+    return matcher
+
+
+def _convert_document(converter, info, owner_org=None, harvest_object=None,
+                      xpath_options=((), (), False, ())):
+    '''Convert a fetched document to a package dictionary. Does not touch
+    the database if 'owner_org' is given and the document is in the storage.
+
+    :param converter: the converter to use
+    :type converter: :class:`ckanext.ddi.dataconverter.DataConverter`
+    :param info: the fetched document, see :meth:`DDIHarvester._read_fetched`
+    :type info: dict
+    :param owner_org: name of the owner organization
+    :type owner_org: string
+    :param harvest_object: harvest object being imported, if in this process
+    :type harvest_object: ckanext.harvest.model.HarvestObject
+    :param xpath_options: options of flattened xpaths, see
+        :func:`_xpath_options`
+    :type xpath_options: tuple
+    :returns: package dictionary or False, conversion errors and a failure
+        ('read' or 'parse', message) if the document could not be converted
+    :rtype: tuple
+    '''
+    xml = info['xml']
+    if info.get('blob'):
+        try:
+            xml = dconverter.load_document(info['blob'])
+        except IOError, ioe:
+            return False, [], ('read', 'Unable to read fetched XML! {io}'
+                               .format(io=ioe))
+    try:
+        ddi_xml = dconverter.parse_ddi(xml)
+    except etree.XMLSyntaxError, err:
+        return False, [], ('parse', 'Unable to parse XML! {er}'
+                           .format(er=err.msg))
+    include, exclude, compress, whitelist = xpath_options
+    package_dict, errors = converter.convert(
+        ddi_xml, info['url'], xml, harvest_object,
+        original_label=info.get('blob'), owner_org=owner_org,
+        xpath_matcher=_get_xpath_matcher(include, exclude))
+    if package_dict and compress:
+        package_dict['xpaths'] = flattener.pack(
+            package_dict['xpaths'], _get_xpath_matcher(include=whitelist))
+    return package_dict or False, errors, None
+
+
+# Converter of a conversion worker process
+_worker_converter = None
+
+
+def _init_conversion_worker():
+    '''Initialize a conversion worker process with a converter kept for
+    the life of the process.
+
+    The workers do not use the database. The database connections inherited
+    from the harvester process must not be touched here: closing one would
+    close it for the harvester too.
+    '''
+    global _worker_converter
+    _worker_converter = dconverter.DataConverter()
+
+
+def _convert_in_worker(args):
+    '''Convert a document in a conversion worker process, see
+    :func:`_convert_document`.
+
+    :param args: the fetched document, the name of the owner organization
+        and the xpath options
+    :type args: tuple
+    '''
+    info, owner_org, xpath_options = args
+    return _convert_document(_worker_converter, info, owner_org,
+                             xpath_options=xpath_options)
+
+
+def _set_extra(harvest_object, key, value):
+    '''Set extra 'key' of 'harvest_object' to 'value'.
+    '''
+    for extra in harvest_object.extras:
+        if extra.key == key:
+            extra.value = value
+            return
+    harvest_object.extras.append(hmodel.HarvestObjectExtra(key=key,
+                                                           value=value))
+
+
+def _del_extra(harvest_object, key):
+    '''Remove extra 'key' of 'harvest_object'.
+    '''
+    for extra in list(harvest_object.extras):
+        if extra.key == key:
+            harvest_object.extras.remove(extra)
+            model.Session.delete(extra)
+
 
 class DDIHarvester(HarvesterBase):
     '''
     DDI Harvester for ckanext-harvester.
     '''
+
     config = None
+    http_client = None
+    package_schema = None
 
     def __init__(self, **kwargs):
         self.ddi_converter = dconverter.DataConverter()
+        self.search_backend = kwargs.get('search_backend') or \
+            searchindex.SearchBackend()
+        # Fetched documents of the import batch: (harvest object, info)
+        self.import_batch = []
 
     def _set_config(self, config_str):
         '''Set the configuration string.
@@ -56,6 +239,39 @@ class DDIHarvester(HarvesterBase):
         else:
             self.config = {}
 
+    def _get_http_client(self):
+        '''Return the HTTP client shared by the harvester stages. A new client
+        is created if the pool settings of the configuration have changed.
+
+        :returns: HTTP client with persistent connections
+        :rtype: :class:`ckanext.ddi.httpclient.HTTPClient`
+        '''
+        config = self.config or {}
+        pool_size = config.get('http_pool_size',
+                               httpclient.DEFAULT_POOL_SIZE)
+        idle_timeout = config.get('http_idle_timeout',
+                                  httpclient.DEFAULT_IDLE_TIMEOUT)
+        client = self.http_client
+        if client is None or (client.pool_size, client.idle_timeout) != \
+                (pool_size, idle_timeout):
+            if client is not None:
+                client.close()
+            client = self.http_client = httpclient.HTTPClient(pool_size,
+                                                              idle_timeout)
+        return client
+
+    def _get_package_schema(self):
+        '''Return the package schema for DDI imports. The schema is built
+        once per process, a shallow copy is returned so that a caller
+        changing it does not change it for the others.
+
+        :rtype: dict
+        '''
+        if self.package_schema is None:
+            DDIHarvester.package_schema = \
+                KataPlugin.create_package_schema_ddi()
+        return dict(self.package_schema)
+
     def info(self):
         '''Return information about this harvester.
         '''
@@ -81,6 +297,22 @@ class DDIHarvester(HarvesterBase):
             try:
                 config_obj = json.loads(config)
                 validate_param(config_obj, 'limit', int)
+                validate_param(config_obj, 'http_pool_size', int)
+                validate_param(config_obj, 'http_idle_timeout', (int, float))
+                validate_param(config_obj, 'force_all', bool)
+                validate_param(config_obj, 'probe_concurrency', int)
+                validate_param(config_obj, 'gather_batch_size', int)
+                validate_param(config_obj, 'import_batch_size', int)
+                validate_param(config_obj, 'defer_indexing', bool)
+                validate_param(config_obj, 'conversion_processes', int)
+                validate_param(config_obj, 'compress_xpaths', bool)
+                for key in ('xpaths_include', 'xpaths_exclude',
+                            'xpaths_whitelist'):
+                    if validate_param(config_obj, key, list) and \
+                            not all(isinstance(prefix, basestring)
+                                    for prefix in config_obj[key]):
+                        raise TypeError("'{p}' needs to be a list of "
+                                        "strings".format(p=key))
             except TypeError as e:
                 raise e
         else:
@@ -141,12 +373,6 @@ class DDIHarvester(HarvesterBase):
         def date_from_config(key):
             return self._datetime_from_str(key, self.config.get(key, None))
 
-        def add_harvest_object(harvest_job, url):
-            harvest_obj = hmodel.HarvestObject(job=harvest_job)
-            harvest_obj.content = url
-            harvest_obj.save()
-            return harvest_obj
-
         from_ = date_from_config('ckanext.harvest.test.from')
         until = date_from_config('ckanext.harvest.test.until')
         previous_job = model.Session.query(hmodel.HarvestJob) \
@@ -165,28 +391,18 @@ class DDIHarvester(HarvesterBase):
         #            obj = add_harvest_object(harvest_job, url)
         #            object_ids.append(obj.id)
         #            log.debug('Retrying record: %s' % url)
+        http_client = self._get_http_client()
         try:
-            urls = urllib2.urlopen(harvest_job.source.url)
-            for url in itertools.islice(urls.readlines(), self.config.get('limit')):
+            listing = http_client.get(harvest_job.source.url)
+            try:
+                # The listing is read only until 'limit' URLs are found
+                urls = itertools.islice(self._read_url_list(listing),
+                                        self.config.get('limit'))
                 if from_ or until:
-                    # This should not fail the whole gather.
-                    try:
-                        request = urllib2.Request(url)
-                        request.get_method = lambda: 'HEAD'
-                        doc_url = urllib2.urlopen(request)
-                        lastmod = parser.parse(doc_url.headers['last-modified'],
-                                               ignoretz=True)
-                    except (urllib2.URLError, urllib2.HTTPError,):
-                    # Actually we do not know if it fits the time limits.
-                    # Rather get it twice than lose it.
-                    # self._add_retry(add_harvest_object(harvest_job, url))
-                        continue
-                    if from_ and lastmod < from_:
-                        continue
-                    if until and until < lastmod:
-                        continue
-                obj = add_harvest_object(harvest_job, url)
-                object_ids.append(obj.id)
+                    urls = self._filter_by_last_modified(urls, from_, until)
+                object_ids = self._add_harvest_objects(harvest_job, urls)
+            finally:
+                listing.close()
         except urllib2.HTTPError, err:
             self._save_gather_error(
                 'HTTPError: Could not gather XML files from URL! ' +
@@ -198,20 +414,198 @@ class DDIHarvester(HarvesterBase):
                 'Error: {er}, urls: {ur}'.format(er=err.reason, ur=harvest_job.source.url),
                 harvest_job)
             return None
-        except Exception as e:
-            log.debug(traceback.format_exc(e))
+        except Exception, err:
+            # Do not harvest a part of a listing, whatever cut it short: an
+            # incomplete body, a timeout or a dropped connection
+            log.debug(traceback.format_exc(err))
+            model.Session.rollback()
+            self._discard_gathered(harvest_job)
+            self._save_gather_error(
+                'Could not read the list of XML files from URL! ' +
+                'Error: {er!r}, urls: {ur}'.format(er=err,
+                                                    ur=harvest_job.source.url),
+                harvest_job)
             return None
         #        self._clear_retries()
         log.info('Gathered %i records from %s.' % (
             len(object_ids), harvest_job.source.url,))
         return object_ids
 
+    def _discard_gathered(self, harvest_job):
+        '''Delete the objects already inserted by the gather stage of
+        'harvest_job', see :meth:`_add_harvest_objects`.
+        '''
+        model.Session.query(hmodel.HarvestObject) \
+            .filter(hmodel.HarvestObject.harvest_job_id == harvest_job.id) \
+            .delete(synchronize_session=False)
+        model.Session.commit()
+
+    def _read_url_list(self, listing):
+        '''Yield the URLs of a URL listing as they are received. Blank lines
+        and repeated URLs are skipped.
+
+        :param listing: response of the listing request
+        :type listing: :class:`ckanext.ddi.httpclient.Response`
+        '''
+        seen = set()
+        for line in listing.iter_lines():
+            url = line.strip()
+            if not url or url in seen:
+                continue
+            seen.add(url)
+            yield url
+
+    def _add_harvest_objects(self, harvest_job, urls):
+        '''Create a harvest object for each of 'urls'. The objects are
+        inserted in batches of 'gather_batch_size' of the config, one
+        transaction per batch.
+
+        :param harvest_job: the gathering job
+        :type harvest_job: ckanext.harvest.model.HarvestJob
+        :param urls: document URLs
+        :type urls: iterable
+        :returns: ids of the created objects
+        :rtype: list
+        '''
+        batch_size = self.config.get('gather_batch_size',
+                                     DEFAULT_GATHER_BATCH_SIZE)
+        object_ids = []
+        urls = iter(urls)
+        while True:
+            batch = [hmodel.HarvestObject(job=harvest_job, guid=url,
+                                          content=url)
+                     for url in itertools.islice(urls, batch_size)]
+            if not batch:
+                break
+            model.Session.add_all(batch)
+            # Flush to get the ids generated for the objects
+            model.Session.flush()
+            object_ids.extend(obj.id for obj in batch)
+            model.Session.commit()
+        return object_ids
+
+    def _probe_last_modified(self, url):
+        '''Get the Last-Modified time of 'url' with a HEAD request.
+
+        :param url: document URL
+        :type url: string
+        :returns: 'url' and its modification time, or None if unknown
+        :rtype: tuple
+        '''
+        # This should not fail the whole gather.
+        try:
+            doc_url = self._get_http_client().head(url)
+            lastmod = parser.parse(doc_url.headers['last-modified'],
+                                   ignoretz=True)
+        except (urllib2.URLError, urllib2.HTTPError, httplib.HTTPException,
+                KeyError, ValueError):
+            lastmod = None
+        return url, lastmod
+
+    def _filter_by_last_modified(self, urls, from_, until):
+        '''Yield the URLs of documents modified between 'from_' and 'until'.
+
+        The documents are probed concurrently, at most 'probe_concurrency'
+        of the config at a time. The URLs are yielded in the original order
+        and read from 'urls' only a window at a time.
+
+        :param urls: document URLs
+        :type urls: iterable
+        :param from_: earliest modification time or None
+        :type from_: datetime.datetime
+        :param until: latest modification time or None
+        :type until: datetime.datetime
+        '''
+        concurrency = self.config.get('probe_concurrency',
+                                      DEFAULT_PROBE_CONCURRENCY)
+        pool = ThreadPool(concurrency)
+        urls = iter(urls)
+        try:
+            while True:
+                window = list(itertools.islice(urls,
+                                               concurrency * PROBE_WINDOW))
+                if not window:
+                    break
+                for url, lastmod in pool.imap(self._probe_last_modified,
+                                              window):
+                    if lastmod is None:
+                        # Actually we do not know if it fits the time limits.
+                        # Rather get it twice than lose it.
+                        yield url
+                        continue
+                    if from_ and lastmod < from_:
+                        continue
+                    if until and until < lastmod:
+                        continue
+                    yield url
+        finally:
+            pool.terminate()
+
+    def _previous_object(self, harvest_object):
+        '''Return the current harvest object of the same source and guid (the
+        document URL), if its package still exists.
+
+        :param harvest_object: harvest object being fetched
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :returns: the harvest object of the last successful import or None
+        :rtype: ckanext.harvest.model.HarvestObject
+        '''
+        if not harvest_object.guid:
+            return None
+        previous = model.Session.query(hmodel.HarvestObject) \
+            .filter(hmodel.HarvestObject.guid == harvest_object.guid) \
+            .filter(hmodel.HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(hmodel.HarvestObject.current == True) \
+            .filter(hmodel.HarvestObject.id != harvest_object.id) \
+            .first()
+        if not previous or not previous.package_id:
+            return None
+        pkg = model.Package.get(previous.package_id)
+        if not pkg or pkg.state != 'active':
+            return None
+        return previous
+
     def fetch_stage(self, harvest_object):
         '''Fetch and parse the DDI XML document.
+
+        The document is requested conditionally with the validators of the
+        last successful import of the same URL. If it is not modified the
+        object is marked unchanged and not imported.
+        '''
+        self._set_config(harvest_object.job.source.config)
+        result = False
+        try:
+            result = self._fetch(harvest_object)
+        finally:
+            if result is not True:
+                # The object does not get to the import stage
+                self._end_stage(harvest_object)
+        return result
+
+    def _fetch(self, harvest_object):
+        '''Fetch a harvest object, see :meth:`fetch_stage`.
         '''
         url = harvest_object.content
+        headers = {}
+        previous = None if self.config.get('force_all') else \
+            self._previous_object(harvest_object)
+        if previous:
+            etag = _get_extra(previous, 'etag')
+            last_modified = _get_extra(previous, 'last_modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
         try:
-            f = urllib2.urlopen(url).read()
+            resp = self._get_http_client().get(url, headers)
+            if resp.code == 304:
+                # Read the empty body to keep the connection
+                resp.read()
+                log.info('Not modified since last harvest: {ur}'.format(
+                    ur=url.strip()))
+                return 'unchanged'
+            f = resp.read()
         except (urllib2.URLError, urllib2.HTTPError,):
         #            self._add_retry(harvest_object)
             self._save_object_error('Could not fetch from url %s!' % url,
@@ -222,61 +616,500 @@ class DDIHarvester(HarvesterBase):
             self._save_object_error('Bad HTTP response status line.',
                                     harvest_object, stage='Fetch')
             return False
-        # Need to pickle the XML so that the data type remains the same.
-        harvest_object.content = pickle.dumps({'url': url, 'xml': f})
+        validators = dict((key, resp.headers[header])
+                          for key, header in VALIDATORS
+                          if header in resp.headers)
+        for key, value in validators.iteritems():
+            _set_extra(harvest_object, key, value)
+        content_hash = dconverter.content_hash(f)
+        # Save the document to the storage and keep only a reference to it.
+        # It is used as the original metadata record of the package.
+        try:
+            blob = dconverter.store_document(
+                f, harvest_object.harvest_source_id, harvest_object.guid,
+                content_hash)
+            f = ''
+        except IOError, ioe:
+            log.debug('Unable to save fetched xml, keeping it in the harvest '
+                      'object: {io}'.format(io=ioe))
+            blob = None
+        # The envelope keeps the data type of the XML and compresses it.
+        harvest_object.content = envelope.encode(
+            url, f, fetched=self._str_from_datetime(datetime.datetime.utcnow()),
+            content_hash=content_hash, blob=blob, **validators)
         return True
 
     def import_stage(self, harvest_object):
         '''Import the metadata received in the fetch stage to a dataset.
 
-        DDI document is parsed to a BeautifulSoup object for metadata
-        extraction. Study (stdyDscr) and document (docDscr) descriptions are
+        DDI document is parsed once to an lxml tree for metadata extraction
+        and flattening. Study (stdyDscr) and document (docDscr) descriptions are
         used. File (fileDscr) and data (dataDscr) description parts of a ddi
         file are saved as csv files (unfinished).
         Also create groups if ones are defined (unfinished).
+
+        A document identical to the one of the last import from the same URL
+        is not imported again, the object is marked unchanged.
+
+        If 'import_batch_size' of the config is greater than one, the objects
+        are collected and imported in batches, see :meth:`_add_to_import_batch`
+        and :meth:`_flush_imports`. An object left waiting in the batch is
+        reported imported. The documents of a batch are converted in
+        'conversion_processes' worker processes if it is set.
+
+        If 'defer_indexing' of the config is set, the packages are not indexed
+        when they are saved but all together when the harvest job has no
+        objects left, see :meth:`_finish_job`.
+
+        The state of the object is left to the harvest consumer.
+        '''
+        self._set_config(harvest_object.job.source.config)
+        try:
+            return self._import(harvest_object)
+        finally:
+            self._end_stage(harvest_object)
+
+    def _import(self, harvest_object):
+        '''Import a harvest object, see :meth:`import_stage`.
+        '''
+        info = self._read_fetched(harvest_object)
+        if info == 'unchanged':
+            return info
+        if self.config.get('import_batch_size', 1) > 1:
+            return self._add_to_import_batch(harvest_object, info)
+        # A batch of one
+        return self._import_batch([(harvest_object, info)])[harvest_object]
+
+    def _read_fetched(self, harvest_object):
+        '''Read the content of 'harvest_object' written by the fetch stage.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :returns: the fetched document, see :func:`envelope.decode`, or
+            'unchanged' if it is identical to the last imported one
+        :rtype: dict or string
         '''
-        # TODO: cPickle might be faster
-        info = pickle.loads(harvest_object.content)
+        info = envelope.decode(harvest_object.content)
         log.info("Harvest object url: {ur}".format(ur=info['url'].strip()))
+        content_hash = info.get('content_hash') or \
+            dconverter.content_hash(info['xml'])
+        previous = None if self.config.get('force_all') else \
+            self._previous_object(harvest_object)
+        if previous and _get_extra(previous, 'content_hash') == content_hash:
+            log.info('Unchanged since last harvest: {ur}'.format(
+                ur=info['url'].strip()))
+            return 'unchanged'
+        _set_extra(harvest_object, 'content_hash', content_hash)
+        return info
+
+    def _convert(self, harvest_object, info):
+        '''Convert a fetched document to a package dictionary. Errors are
+        saved to 'harvest_object'.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :param info: the fetched document, see :meth:`_read_fetched`
+        :type info: dict
+        :returns: package dictionary or False
+        :rtype: dict
+        '''
+        result = _convert_document(self.ddi_converter, info,
+                                   harvest_object=harvest_object,
+                                   xpath_options=_xpath_options(self.config))
+        return self._conversion_result(harvest_object, info, result)
+
+    def _convert_batch(self, batch):
+        '''Convert the documents of 'batch' in conversion worker processes
+        started for the batch. The workers only convert; reading the
+        database and saving the errors is done here.
+
+        Documents not in the storage are saved there first as the workers
+        can't save them. Documents which can't be saved are converted in this
+        process.
+
+        :param batch: harvest objects and fetched documents
+        :type batch: list of tuples
+        :returns: package dictionaries or False in the order of 'batch'
+        :rtype: list
+        '''
+        package_dicts = [None] * len(batch)
+        work = []
+        for n, (harvest_object, info) in enumerate(batch):
+            if not info.get('blob'):
+                try:
+                    info['blob'] = dconverter.store_document(
+                        info['xml'], harvest_object.harvest_source_id,
+                        harvest_object.guid,
+                        _get_extra(harvest_object, 'content_hash') or
+                        dconverter.content_hash(info['xml']))
+                    info['xml'] = ''
+                except IOError:
+                    package_dicts[n] = self._convert(harvest_object, info)
+                    continue
+            try:
+                owner_org = self.ddi_converter.get_owner_org(harvest_object)
+            except Exception, e:
+                log.debug(traceback.format_exc(e))
+                package_dicts[n] = self._convert(harvest_object, info)
+                continue
+            work.append((n, (info, owner_org, _xpath_options(self.config))))
+        if not work:
+            return package_dicts
+        # The workers are stopped after the batch so that none is left
+        # behind or started later from this process.
+        pool = multiprocessing.Pool(
+            min(self.config['conversion_processes'], len(work)),
+            initializer=_init_conversion_worker)
         try:
-            ddi_xml = BeautifulSoup(info['xml'], 'xml')
-        except etree.XMLSyntaxError, err:
-            self._save_object_error('Unable to parse XML! {er}'
-                                    .format(er=err.msg), harvest_object,
-                                    'Import')
-            # I presume source sent wrong data but it arrived correctly.
-            # This could result in a case where incorrect source is tried
-            # over and over again without success.
-            del info['xml']
-            harvest_object.content = info['url']
-            #            self._add_retry(harvest_object)
-            return False
+            # One document per task for an even load on the workers
+            results = pool.map(_convert_in_worker, [args for _, args in work],
+                               chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        for (n, _), result in zip(work, results):
+            harvest_object, info = batch[n]
+            package_dicts[n] = self._conversion_result(harvest_object, info,
+                                                       result)
+        return package_dicts
 
-        package_dict = self.ddi_converter.ddi2ckan(ddi_xml, info['url'],
-                                                   info['xml'], harvest_object)
+    def _conversion_result(self, harvest_object, info, result):
+        '''Save the errors of converting the document of 'harvest_object'.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :param info: the fetched document, see :meth:`_read_fetched`
+        :type info: dict
+        :param result: result of :func:`_convert_document`
+        :type result: tuple
+        :returns: package dictionary or False
+        :rtype: dict
+        '''
+        package_dict, errors, failure = result
+        if failure:
+            kind, message = failure
+            self._save_object_error(message, harvest_object, 'Import')
+            if kind == 'parse':
+                # I presume source sent wrong data but it arrived correctly.
+                # This could result in a case where incorrect source is tried
+                # over and over again without success.
+                info.pop('xml', None)
+                harvest_object.content = info['url']
+                #            self._add_retry(harvest_object)
+            return False
+        if package_dict:
+            harvest_object.content = None
 
         # Obsolete for now, as we only have one pid
         # pkg_id = ckanext.kata.utils.get_package_id_by_data_pids(package_dict)
         # pkg = model.Session.query(model.Package).filter(model.Package.id == pkg_id).first() if pkg_id else None
         # package_dict['id'] = pkg.id if pkg else generate_pid()
 
-        errors = self.ddi_converter.get_errors()
-        if errors:
-            # FIXME: Using line number here hazardous. Old _read_value doesn't support
-            for er, line in errors:
-                self._save_object_error('Invalid or missing mandatory metadata in {ur}. '
-                                        '{er}'.format(ur=info['url'], er=er),
-                                        harvest_object,
-                                        'Import',
-                                        line)
-            self.ddi_converter.empty_errors()
-        if not package_dict:
+        for er, line in errors:
+            self._save_object_error('Invalid or missing mandatory metadata in {ur}. '
+                                    '{er}'.format(ur=info['url'], er=er),
+                                    harvest_object,
+                                    'Import',
+                                    line)
+        return package_dict
+
+    def _unchanged_package(self, harvest_object, package_dict):
+        '''Check if the package converted from 'harvest_object' is the same
+        as the one of the previous import. If it is, 'harvest_object' becomes
+        the current object of the package without updating the package and
+        is flagged with UNCHANGED_EXTRA so that the package is not indexed
+        again, see :meth:`_job_package_ids`.
+
+        The fingerprint of the package is saved to 'harvest_object'.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :param package_dict: converted package
+        :type package_dict: dict
+        :rtype: boolean
+        '''
+        fingerprint = _package_fingerprint(package_dict)
+        _set_extra(harvest_object, 'fingerprint', fingerprint)
+        previous = None if self.config.get('force_all') else \
+            self._previous_object(harvest_object)
+        if not previous or _get_extra(previous, 'fingerprint') != fingerprint:
             return False
-        schema = KataPlugin.create_package_schema_ddi()
-        result = self._create_or_update_package(package_dict, harvest_object,
-                                                schema)
-        log.debug("Exiting import_stage()")
-        return result  # returns True
+        log.info('Package {pk} not changed'.format(pk=previous.package_id))
+        previous.current = False
+        harvest_object.package_id = previous.package_id
+        harvest_object.current = True
+        _set_extra(harvest_object, UNCHANGED_EXTRA, 'true')
+        model.Session.add_all([previous, harvest_object])
+        return True
+
+    def _add_to_import_batch(self, harvest_object, info):
+        '''Add a fetched document to the import batch. The batch is imported
+        when it is full, when an object of another harvest job comes or when
+        the job has no other objects to fetch or import.
+
+        An object left waiting is flagged with QUEUED_EXTRA until its package
+        is written, so that the process finishing the job can import it if
+        this process does not get to it, see :meth:`_import_stranded`.
+
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :param info: the fetched document, see :meth:`_read_fetched`
+        :type info: dict
+        :returns: True if the object waits in the batch, else the result of
+            importing it, see :meth:`_flush_imports`
+        :rtype: boolean or string
+        '''
+        if self.import_batch and \
+                self.import_batch[0][0].harvest_job_id != \
+                harvest_object.harvest_job_id:
+            self._flush_imports()
+        self.import_batch.append((harvest_object, info))
+        if len(self.import_batch) >= self.config['import_batch_size'] or \
+                not self._pending_objects(harvest_object):
+            return self._flush_imports()[harvest_object]
+        # Committed when the object leaves the stage, see _end_stage()
+        _set_extra(harvest_object, QUEUED_EXTRA, 'true')
+        return True
+
+    def _pending_objects(self, harvest_object):
+        '''Return the number of other objects of the harvest job of
+        'harvest_object' still to be fetched or imported. Objects flagged with
+        DONE_EXTRA have left the harvester whatever their state.
+        '''
+        return model.Session.query(hmodel.HarvestObject.id) \
+            .filter(hmodel.HarvestObject.harvest_job_id ==
+                    harvest_object.harvest_job_id) \
+            .filter(hmodel.HarvestObject.state.in_(PENDING_STATES)) \
+            .filter(hmodel.HarvestObject.id != harvest_object.id) \
+            .filter(~hmodel.HarvestObject.extras.any(
+                hmodel.HarvestObjectExtra.key == DONE_EXTRA)) \
+            .count()
+
+    def _end_stage(self, harvest_object):
+        '''Called when 'harvest_object' leaves the fetch or the import stage
+        without going on to the next one. The harvest job is finished if it
+        has no other objects to fetch or import.
+
+        The object is flagged with DONE_EXTRA and committed before counting
+        the objects left, so that of two processes ending the last objects of
+        a job at the same time at least one finishes the job.
+
+        :param harvest_object: harvest object leaving the harvester
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        '''
+        _set_extra(harvest_object, DONE_EXTRA, 'true')
+        model.Session.add(harvest_object)
+        model.Session.commit()
+        if not self._pending_objects(harvest_object):
+            self._finish_job(harvest_object.harvest_job_id)
+
+    def _finish_job(self, harvest_job_id):
+        '''Import what is left of the harvest job: the import batch of this
+        process and the objects left waiting by other processes. Index the
+        packages of the job if 'defer_indexing' of the config is set.
+
+        :param harvest_job_id: id of the harvest job
+        :type harvest_job_id: string
+        '''
+        self._flush_imports()
+        self._import_stranded(harvest_job_id)
+        if self.config.get('defer_indexing'):
+            self._index_job(harvest_job_id)
+
+    def _import_stranded(self, harvest_job_id):
+        '''Import the objects of the harvest job left waiting in the import
+        batch of another process, flagged with QUEUED_EXTRA.
+
+        :param harvest_job_id: id of the harvest job
+        :type harvest_job_id: string
+        '''
+        stranded = self._stranded_objects(harvest_job_id)
+        if not stranded:
+            return
+        log.info('Importing {n} objects left waiting in an import batch'
+                 .format(n=len(stranded)))
+        self.import_batch = [(harvest_object,
+                              envelope.decode(harvest_object.content))
+                             for harvest_object in stranded]
+        self._flush_imports()
+
+    def _stranded_objects(self, harvest_job_id):
+        '''Return the objects of the harvest job flagged with QUEUED_EXTRA.
+        '''
+        return model.Session.query(hmodel.HarvestObject) \
+            .join(hmodel.HarvestObjectExtra,
+                  hmodel.HarvestObjectExtra.harvest_object_id ==
+                  hmodel.HarvestObject.id) \
+            .filter(hmodel.HarvestObject.harvest_job_id == harvest_job_id) \
+            .filter(hmodel.HarvestObjectExtra.key == QUEUED_EXTRA) \
+            .all()
+
+    def _claim_queued(self, batch):
+        '''Lock the flags of the objects of 'batch' waiting in an import
+        batch until the end of the transaction and leave out the objects
+        another process has imported already.
+
+        The objects which have left the import stage (flagged with
+        DONE_EXTRA) waited in a batch. Their QUEUED_EXTRA is read from the
+        database as another process may have removed it.
+
+        :param batch: harvest objects and package dictionaries
+        :type batch: list of tuples
+        :rtype: list of tuples
+        '''
+        queued_ids = [harvest_object.id for harvest_object, _ in batch
+                      if _get_extra(harvest_object, DONE_EXTRA)]
+        if not queued_ids:
+            return batch
+        flagged = set(object_id for (object_id,) in
+                      model.Session.query(
+                          hmodel.HarvestObjectExtra.harvest_object_id)
+                      .filter(hmodel.HarvestObjectExtra.harvest_object_id
+                              .in_(queued_ids))
+                      .filter(hmodel.HarvestObjectExtra.key == QUEUED_EXTRA)
+                      .with_lockmode('update'))
+        return [(harvest_object, package_dict)
+                for harvest_object, package_dict in batch
+                if harvest_object.id in flagged or
+                not _get_extra(harvest_object, DONE_EXTRA)]
+
+    def _flush_imports(self):
+        '''Import the batch of collected objects in one transaction.
+
+        Each package is written in its own savepoint so that a failing record
+        does not spoil the others. An object which waited in the batch and
+        failed is marked failed, it was reported imported when it left the
+        import stage. Packages are not indexed one at a time but all at once
+        after the transaction is committed.
+
+        :returns: the result of each object of the batch like that of
+            :meth:`import_stage`
+        :rtype: dict
+        '''
+        batch, self.import_batch = self.import_batch, []
+        if not batch:
+            return {}
+        # The batch may be of another harvest source than the object at hand
+        config = self.config
+        self._set_config(batch[0][0].job.source.config)
+        try:
+            return self._import_batch(batch)
+        finally:
+            self.config = config
+
+    def _import_batch(self, batch):
+        '''Import 'batch', see :meth:`_flush_imports`.
+        '''
+        # Converting may save errors, which commits the session, so convert
+        # all before writing.
+        if self.config.get('conversion_processes') and len(batch) > 1:
+            package_dicts = self._convert_batch(batch)
+        else:
+            package_dicts = [self._convert(harvest_object, info)
+                             for harvest_object, info in batch]
+        results = {}
+        failed = []
+        package_ids = []
+        with self.search_backend.automatic_indexing_suppressed():
+            claimed = self._claim_queued(
+                [(harvest_object, package_dict) for (harvest_object, _),
+                 package_dict in zip(batch, package_dicts)])
+            for harvest_object, package_dict in claimed:
+                if not package_dict:
+                    results[harvest_object] = False
+                    continue
+                if self._unchanged_package(harvest_object, package_dict):
+                    results[harvest_object] = 'unchanged'
+                    continue
+                savepoint = model.Session.begin_nested()
+                try:
+                    package_ids.append(self._write_package(package_dict,
+                                                           harvest_object))
+                    savepoint.commit()
+                    results[harvest_object] = True
+                except Exception, e:
+                    savepoint.rollback()
+                    log.debug(traceback.format_exc(e))
+                    failed.append((harvest_object, e))
+                    results[harvest_object] = False
+            for harvest_object, result in results.iteritems():
+                if not result:
+                    harvest_object.current = False
+                    if _get_extra(harvest_object, DONE_EXTRA):
+                        # Reported imported when it was left waiting
+                        harvest_object.state = 'ERROR'
+                _del_extra(harvest_object, QUEUED_EXTRA)
+                model.Session.add(harvest_object)
+            model.Session.commit()
+        # Saving an error commits the session, so do it after the batch
+        for harvest_object, e in failed:
+            self._save_object_error('Unable to save package: {er}'.format(
+                er=getattr(e, 'error_dict', e)), harvest_object, 'Import')
+        log.info('Imported {n} of {to} packages'.format(n=len(package_ids),
+                                                       to=len(batch)))
+        if not self.config.get('defer_indexing'):
+            self.search_backend.index_packages(package_ids)
+        return results
+
+    def _index_job(self, harvest_job_id):
+        '''Index the packages written by the harvest job, see
+        :meth:`_job_package_ids`.
+
+        :param harvest_job_id: id of the harvest job
+        :type harvest_job_id: string
+        '''
+        package_ids = self._job_package_ids(harvest_job_id)
+        log.info('Indexing {n} packages of harvest job {id}'.format(
+            n=len(package_ids), id=harvest_job_id))
+        self.search_backend.index_packages(package_ids)
+
+    def _job_package_ids(self, harvest_job_id):
+        '''Return the ids of the packages written by the harvest job: those of
+        which an object of the job is the current one, leaving out the
+        packages found unchanged.
+        '''
+        return [package_id for (package_id,) in
+                model.Session.query(hmodel.HarvestObject.package_id)
+                .filter(hmodel.HarvestObject.harvest_job_id == harvest_job_id)
+                .filter(hmodel.HarvestObject.current == True)
+                .filter(hmodel.HarvestObject.package_id != None)
+                .filter(~hmodel.HarvestObject.extras.any(
+                    hmodel.HarvestObjectExtra.key == UNCHANGED_EXTRA))]
+
+    def _write_package(self, package_dict, harvest_object):
+        '''Create or update a package without committing and make
+        'harvest_object' the current object of the package. All imports
+        write their packages here, see :meth:`_import_batch`.
+
+        :param package_dict: converted package
+        :type package_dict: dict
+        :param harvest_object: harvest object being imported
+        :type harvest_object: ckanext.harvest.model.HarvestObject
+        :returns: id of the package
+        :rtype: string
+        '''
+        context = {'model': model, 'session': model.Session,
+                   'user': self._get_user_name(), 'ignore_auth': True,
+                   'schema': self._get_package_schema(), 'defer_commit': True}
+        pkg = model.Package.get(package_dict['id']) or \
+            model.Package.get(package_dict['name'])
+        if pkg:
+            package_dict['id'] = pkg.id
+            package_dict['name'] = pkg.name
+            package_id = get_action('package_update')(context,
+                                                      package_dict)['id']
+        else:
+            package_id = get_action('package_create')(context,
+                                                      package_dict)['id']
+        # Flag the other objects of the package as not current anymore
+        model.Session.query(hmodel.HarvestObject) \
+            .filter(hmodel.HarvestObject.package_id == package_id) \
+            .filter(hmodel.HarvestObject.id != harvest_object.id) \
+            .update({'current': False}, synchronize_session=False)
+        harvest_object.package_id = package_id
+        harvest_object.current = True
+        model.Session.add(harvest_object)
+        return package_id
 
     def fetch_xml(self, url, context):
         '''Get xml for import. Shortened from :meth:`fetch_stage`
@@ -289,7 +1122,7 @@ class DDIHarvester(HarvesterBase):
         '''
         try:
             log.debug('Requesting url {ur}'.format(ur=url))
-            f = urllib2.urlopen(url).read()
+            f = self._get_http_client().get(url).read()
             return self.parse_xml(f, context, url)
         except (urllib2.URLError, urllib2.HTTPError,):
             log.debug('fetch_xml: Could not fetch from url {ur}!'.format(ur=url))
@@ -310,20 +1143,16 @@ class DDIHarvester(HarvesterBase):
         :rtype: dict
         '''
         try:
-            ddi_xml = BeautifulSoup(f, 'xml')
+            ddi_xml = dconverter.parse_ddi(f)
         except etree.XMLSyntaxError, err:
             log.debug('Unable to parse XML! {er}'.format(er=err.msg))
             return None
-        package_dict = self.ddi_converter.ddi2ckan(ddi_xml, orig_url, f,
-                                                   context=context,
-                                                   strict=strict)
-        errors = self.ddi_converter.get_errors()
-        if errors:
-            # FIXME: Can't use line number here. Old _read_value doesn't provide
-            for er in errors:
-                log.debug('Invalid or missing mandatory metadata in {ur}. '
-                          '{er}'.format(ur=orig_url, er=er))
-            self.ddi_converter.empty_errors()
+        package_dict, errors = self.ddi_converter.convert(ddi_xml, orig_url, f,
+                                                          context=context,
+                                                          strict=strict)
+        for er, line in errors:
+            log.debug('Invalid or missing mandatory metadata in {ur}. '
+                      '{er} (line {li})'.format(ur=orig_url, er=er, li=line))
         return package_dict
 
 #
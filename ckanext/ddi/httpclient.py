@@ -0,0 +1,298 @@
+# coding: utf-8
+'''
+Pooled keep-alive HTTP client for the DDI harvester
+'''
+
+#pylint: disable-msg=E1101
+import base64
+import httplib
+import logging
+import socket
+import StringIO
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 30
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+USER_AGENT = 'ckanext-ddi'
+CONNECTION_CLASSES = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection,
+}
+
+
+def _parse_proxy(proxy):
+    '''Return the address of proxy URL 'proxy' and the Proxy-Authorization
+    header for its credentials, or None.
+    '''
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parts = urlparse.urlsplit(proxy)
+    address = parts.netloc.rpartition('@')[2]
+    auth = None
+    if parts.username is not None:
+        credentials = '%s:%s' % (urllib.unquote(parts.username),
+                                 urllib.unquote(parts.password or ''))
+        auth = 'Basic ' + base64.b64encode(credentials)
+    return address, auth
+
+
+class Response(object):
+    '''Response of :meth:`HTTPClient.request`. Works like the response of
+    urllib2.urlopen() in the ways the harvester uses it.
+
+    The connection is returned to the pool when the body has been read to the
+    end. Closing a response before that closes the connection. A body ending
+    before its Content-Length raises httplib.IncompleteRead.
+    '''
+
+    def __init__(self, client, key, conn, resp, url):
+        self.url = url
+        self.code = resp.status
+        self.msg = resp.reason
+        # httplib gives header names in lower case
+        self.headers = dict(resp.getheaders())
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        '''Read 'amt' bytes of the body, or all of it.
+        '''
+        if self._resp is None:
+            return ''
+        data = self._resp.read(amt) if amt is not None else self._resp.read()
+        if self._resp.isclosed():
+            missing = self._resp.length
+            if missing:
+                # httplib ends a partial read of a body cut short silently
+                self._conn.close()
+                self._resp = self._conn = None
+                raise httplib.IncompleteRead(data, missing)
+            self._release()
+        return data
+
+    def iter_lines(self, chunk_size=8192):
+        '''Yield the lines of the body without line endings as they are
+        received.
+
+        :param chunk_size: number of bytes read at a time
+        :type chunk_size: int
+        '''
+        pending = ''
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+        if pending:
+            yield pending
+
+    def close(self):
+        '''Close the response. An unread body is not drained, the connection
+        is closed instead.
+        '''
+        if self._resp is None:
+            return
+        if self._resp.isclosed():
+            self._release()
+        else:
+            self._resp.close()
+            self._conn.close()
+            self._resp = self._conn = None
+
+    def _release(self):
+        self._client._put(self._key, self._conn, self._resp.will_close)
+        self._resp = self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPClient(object):
+    '''HTTP client keeping persistent connections in a pool per host. Shared
+    by the harvester stages and safe to use from several threads.
+
+    Errors are raised as urllib2.HTTPError (status 400 and above) and
+    urllib2.URLError (connection failures) so callers can handle them like
+    urllib2.urlopen() errors.
+
+    Like urllib2, requests go through the proxies of the http_proxy and
+    https_proxy environment variables, except to the hosts in no_proxy. HTTP
+    requests are sent to the proxy, HTTPS requests are tunneled through it
+    with CONNECT.
+
+    :param pool_size: maximum number of idle connections kept per host
+    :type pool_size: int
+    :param idle_timeout: seconds after which an idle connection is dropped
+    :type idle_timeout: int or float
+    :param proxies: proxy URL per scheme, by default urllib.getproxies()
+    :type proxies: dict
+    '''
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, proxies=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _route(self, scheme, netloc):
+        '''Return how requests to 'netloc' are sent: the pool key of their
+        connections, the headers to add and whether the request line has the
+        absolute URL.
+
+        The key is the scheme, the address connected to, and with an HTTPS
+        proxy the host tunneled to and the Proxy-Authorization header of the
+        tunnel.
+        '''
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(netloc):
+            return (scheme, netloc, None, None), {}, False
+        address, auth = _parse_proxy(proxy)
+        if scheme == 'https':
+            return (scheme, address, netloc, auth), {}, False
+        headers = {'Proxy-Authorization': auth} if auth else {}
+        return (scheme, address, None, None), headers, True
+
+    def _get(self, key):
+        '''Get an idle connection to 'key' from the pool, or a new one.
+        Returns the connection and whether it was reused.
+        '''
+        now = time.time()
+        with self._lock:
+            pool = self._pools.get(key, [])
+            while pool:
+                conn, last_used = pool.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        scheme, address, tunnel, auth = key
+        conn = CONNECTION_CLASSES[scheme](address)
+        if tunnel:
+            conn.set_tunnel(tunnel, headers=auth and {
+                'Proxy-Authorization': auth})
+        return conn, False
+
+    def _put(self, key, conn, will_close=False):
+        '''Return connection 'conn' to the pool of 'key'.
+        '''
+        if will_close:
+            conn.close()
+            return
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        '''Close all idle connections.
+        '''
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.itervalues():
+            for conn, _ in pool:
+                conn.close()
+
+    def _send(self, method, url, headers):
+        '''Send a single request without following redirects.
+        '''
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in CONNECTION_CLASSES:
+            raise urllib2.URLError('unknown url type: %s' % scheme)
+        key, proxy_headers, absolute = self._route(scheme, parts.netloc)
+        path = urlparse.urlunsplit((scheme if absolute else '',
+                                    parts.netloc if absolute else '',
+                                    parts.path or '/', parts.query, ''))
+        req_headers = {'User-Agent': USER_AGENT}
+        req_headers.update(proxy_headers)
+        req_headers.update(headers or {})
+        while True:
+            conn, reused = self._get(key)
+            try:
+                conn.request(method, path, headers=req_headers)
+                resp = conn.getresponse()
+            except (socket.error, httplib.BadStatusLine), err:
+                conn.close()
+                # The server may have closed an idle keep-alive connection.
+                # Retry until a new connection fails.
+                if reused:
+                    continue
+                if isinstance(err, socket.error):
+                    raise urllib2.URLError(err)
+                raise
+            except httplib.HTTPException:
+                conn.close()
+                raise
+            response = Response(self, key, conn, resp, url)
+            if method == 'HEAD':
+                # No body, return the connection to the pool now
+                response.read()
+            return response
+
+    def request(self, url, method='GET', headers=None):
+        '''Request 'url' following redirects.
+
+        :param url: the URL to request
+        :type url: string
+        :param method: HTTP method, GET or HEAD
+        :type method: string
+        :param headers: additional request headers
+        :type headers: dict
+        :returns: the response, read it to the end or close it
+        :rtype: :class:`Response`
+        '''
+        url = url.strip()
+        for _ in xrange(MAX_REDIRECTS + 1):
+            resp = self._send(method, url, headers)
+            if resp.code in REDIRECT_CODES and 'location' in resp.headers:
+                resp.read()
+                url = urlparse.urljoin(url, resp.headers['location'])
+                log.debug('Redirected to {ur}'.format(ur=url))
+                continue
+            if resp.code >= 400:
+                body = resp.read()
+                raise urllib2.HTTPError(url, resp.code, resp.msg,
+                                        resp.headers, StringIO.StringIO(body))
+            return resp
+        resp.close()
+        raise urllib2.HTTPError(url, resp.code, 'Too many redirects',
+                                resp.headers, None)
+
+    def get(self, url, headers=None):
+        '''Shortcut for a GET :meth:`request`.
+        '''
+        return self.request(url, 'GET', headers)
+
+    def head(self, url, headers=None):
+        '''Shortcut for a HEAD :meth:`request`.
+        '''
+        return self.request(url, 'HEAD', headers)
@@ -0,0 +1,28 @@
+# coding: utf-8
+'''
+Search index plugin for packages harvested with the DDI harvester
+'''
+
+#pylint: disable-msg=E1101
+import ckan.plugins as plugins
+
+import flattener
+
+
+class DDIIndexPlugin(plugins.SingletonPlugin):
+    '''
+    Leaves the compressed xpaths of DDI packages out of the search index, see
+    'compress_xpaths' of the harvester config.
+    '''
+    plugins.implements(plugins.IPackageController, inherit=True)
+
+    def before_index(self, pkg_dict):
+        '''Drop the compressed xpaths from the index fields of a package.
+        They are not searchable, see 'xpaths_whitelist' of the harvester
+        config. Packages without them are not touched.
+        '''
+        if 'extras_' + flattener.PACKED_INDEX_KEY not in pkg_dict:
+            return pkg_dict
+        del pkg_dict['extras_' + flattener.PACKED_INDEX_KEY]
+        pkg_dict.pop(flattener.PACKED_INDEX_KEY, None)
+        return pkg_dict
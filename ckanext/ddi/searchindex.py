@@ -0,0 +1,114 @@
+# coding: utf-8
+'''
+Search index operations of the DDI harvester
+'''
+
+#pylint: disable-msg=E1101
+import contextlib
+import functools
+import logging
+import threading
+
+import ckan.lib.search as search
+import ckan.logic as logic
+import ckan.model as model
+
+
+log = logging.getLogger(__name__)
+
+# Number of packages indexed per search index commit
+INDEX_COMMIT_SIZE = 1000
+
+# Depth of automatic_indexing_suppressed() in each thread
+_suppressed = threading.local()
+# Number of automatic_indexing_suppressed() contexts open in the process and
+# the original notify of the search plugin while it is replaced
+_patch = {'count': 0, 'notify': None}
+_patch_lock = threading.Lock()
+
+
+def _suppressible(notify):
+    '''Wrap 'notify' of a search plugin to do nothing in the threads which
+    suppress automatic indexing.
+    '''
+    @functools.wraps(notify)
+    def wrapper(*args, **kwargs):
+        if getattr(_suppressed, 'depth', 0):
+            return None
+        return notify(*args, **kwargs)
+    return wrapper
+
+
+def _patch_notify():
+    '''Replace the notify of the search plugin of CKAN with a suppressible
+    one unless it is replaced already.
+    '''
+    with _patch_lock:
+        if not _patch['count']:
+            plugin = search.SynchronousSearchPlugin
+            _patch['notify'] = plugin.__dict__['notify']
+            plugin.notify = _suppressible(_patch['notify'])
+        _patch['count'] += 1
+
+
+def _restore_notify():
+    '''Restore the original notify of the search plugin of CKAN when no
+    context suppressing automatic indexing is left.
+    '''
+    with _patch_lock:
+        _patch['count'] -= 1
+        if not _patch['count']:
+            search.SynchronousSearchPlugin.notify = _patch['notify']
+            _patch['notify'] = None
+
+
+class SearchBackend(object):
+    '''Search index used by the harvester for batched and deferred indexing.
+    Can be replaced, for example with a stand-in in tests, see the
+    'search_backend' argument of :class:`ckanext.ddi.harvester.DDIHarvester`.
+    '''
+
+    @contextlib.contextmanager
+    def automatic_indexing_suppressed(self):
+        '''Context in which CKAN does not index the packages committed by the
+        calling thread. Index them afterwards with :meth:`index_packages`.
+
+        CKAN has no setting for this per call, so the notify of its search
+        plugin is replaced while any thread is in the context and restored
+        when the last one leaves. Notifications of other threads are passed
+        on unchanged.
+        '''
+        _patch_notify()
+        _suppressed.depth = getattr(_suppressed, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            _suppressed.depth -= 1
+            _restore_notify()
+
+    def index_packages(self, package_ids):
+        '''Index packages, committing the index once per INDEX_COMMIT_SIZE
+        packages.
+
+        :param package_ids: ids of the packages
+        :type package_ids: list
+        '''
+        if not package_ids:
+            return
+        package_index = search.index_for(model.Package)
+        for n, package_id in enumerate(package_ids, 1):
+            context = {'model': model, 'session': model.Session,
+                       'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                pkg_dict = logic.get_action('package_show')(
+                    context, {'id': package_id})
+            except logic.NotFound:
+                log.debug('Not indexing missing package {id}'.format(
+                    id=package_id))
+                continue
+            package_index.update_dict(pkg_dict, defer_commit=True)
+            if n % INDEX_COMMIT_SIZE == 0:
+                package_index.commit()
+        package_index.commit()
+        log.debug('Indexed {n} packages'.format(n=len(package_ids)))
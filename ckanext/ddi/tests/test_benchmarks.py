@@ -0,0 +1,293 @@
+# coding: utf-8
+'''
+Benchmarks for DDI harvester
+
+Not run by default as they take time. Run with for example:
+
+    DDI_BENCHMARKS=1 nosetests --ckan --with-pylons=ckanext-ddi/test-core.ini ckanext-ddi/ckanext/ddi/tests/test_benchmarks.py
+
+The results are logged at INFO level. nose captures the log and shows it
+only for failing tests; add --nologcapture to see it with the logging
+configuration in use.
+'''
+# pylint: disable=E1101,C1101,C0111
+
+import glob
+import inspect
+import logging
+import multiprocessing
+import os
+import pickle
+import timeit
+import unittest
+
+from nose.exc import SkipTest
+
+from ckan.logic import get_action
+import ckan.model as model
+import ckanext.harvest.model as harvest_model
+import ckanext.oaipmh.importcore as importcore
+import ckanext.ddi.dataconverter as dconverter
+import ckanext.ddi.envelope as envelope
+import ckanext.ddi.flattener as flattener
+import ckanext.ddi.harvester as dharvester
+from ckanext.kata.plugin import KataPlugin
+import testdata
+
+log = logging.getLogger(__name__)
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..',
+                                         'test_fixtures', '*.xml')))
+
+
+def _bench(label, func, number=1000, repeat=3):
+    '''Log and return the best time of 'func' in microseconds per call.
+    '''
+    best = min(timeit.Timer(func).repeat(repeat, number)) / number * 1e6
+    log.info('{la:<50} {ti:12.2f} us/call'.format(la=label, ti=best))
+    return best
+
+
+def _inspect_except_return(exceptions, returns=u''):
+    '''ExceptReturn as it was before field identities, for comparison.
+    '''
+    def decorator(f):
+        def call(*args, **kwargs):
+            try:
+                return f(*args, **kwargs)
+            except exceptions:
+                frame = inspect.currentframe()
+                caller_record = inspect.getouterframes(frame)[1]
+                line_num = caller_record[2]
+                call_line = caller_record[4][0]
+                call_arg = call_line.strip().split(')', 1)[0]
+                del frame
+                dconverter.log.info('Unable to read optional value: {carg} '
+                                    '(line {li})'.format(li=line_num,
+                                                         carg=call_arg))
+                return returns
+        return call
+    return decorator
+
+
+class _Getters(object):
+
+    def __init__(self):
+        self.errors = []
+
+    @_inspect_except_return(AttributeError)
+    def get_inspected(self, start_tag):
+        return start_tag.text
+
+    @dconverter.ExceptReturn(AttributeError, field='discipline')
+    def get_field(self, start_tag):
+        return start_tag.text
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        if not os.environ.get('DDI_BENCHMARKS'):
+            raise SkipTest('Set DDI_BENCHMARKS=1 to run benchmarks')
+
+    def test_optional_field_miss(self):
+        getters = _Getters()
+        before = _bench('Optional field miss, inspect.getouterframes',
+                        lambda: getters.get_inspected(None), number=200)
+        after = _bench('Optional field miss, field identity',
+                       lambda: getters.get_field(None))
+        log.info('Speedup: {sp:.0f}x'.format(sp=before / after))
+        assert after < before
+
+    def test_content_envelope(self):
+        docs = []
+        for path in FIXTURES:
+            with open(path) as f:
+                docs.append((u'http://www.fsd.uta.fi/' + os.path.basename(path),
+                             f.read()))
+        pickled = [pickle.dumps({'url': url, 'xml': xml})
+                   for url, xml in docs]
+        enveloped = [envelope.encode(url, xml, etag='"1"') for url, xml in docs]
+        before_size = sum(len(content) for content in pickled)
+        after_size = sum(len(content) for content in enveloped)
+        log.info('Content of {n} fixtures, pickle {bs} bytes, envelope {as_} '
+                 'bytes ({ra:.1f}x smaller)'.format(
+                     n=len(docs), bs=before_size, as_=after_size,
+                     ra=float(before_size) / after_size))
+        _bench('Encode fixtures, pickle',
+               lambda: [pickle.dumps({'url': url, 'xml': xml})
+                        for url, xml in docs], number=5)
+        _bench('Encode fixtures, envelope',
+               lambda: [envelope.encode(url, xml) for url, xml in docs],
+               number=5)
+        _bench('Decode fixtures, pickle',
+               lambda: [pickle.loads(content) for content in pickled],
+               number=5)
+        _bench('Decode fixtures, envelope',
+               lambda: [envelope.decode(content) for content in enveloped],
+               number=5)
+        assert after_size < before_size
+
+    def test_package_schema(self):
+        # Meaningful only with the package schema of ckanext-kata
+        harvester = dharvester.DDIHarvester()
+        converter = dconverter.DataConverter()
+
+        def convert():
+            converter.ddi2ckan(dconverter.parse_ddi(testdata.nr1),
+                               u'http://www.fsd.uta.fi/FSD1049.xml',
+                               testdata.nr1, context={'user': u'benchmark'})
+            converter.empty_errors()
+
+        conversion = _bench('Convert testdata.nr1', convert, number=20)
+        before = _bench('Package schema, create_package_schema_ddi()',
+                        KataPlugin.create_package_schema_ddi, number=200)
+        after = _bench('Package schema, reused',
+                       harvester._get_package_schema)
+        log.info('Share of conversion and schema: {be:.1%} -> {af:.1%}'
+                 .format(be=before / (conversion + before),
+                         af=after / (conversion + after)))
+        assert after < before
+
+    def test_document_index(self):
+        ddi_xml = dconverter.parse_ddi(testdata.nr1)
+        citation = ddi_xml.find('stdyDscr/citation')
+        searches = [(citation, 'AuthEnty', {}), (citation, 'othId', {}),
+                    (citation, 'prodDate', {}), (citation, 'version', {}),
+                    (ddi_xml, 'geogCover', {}), (ddi_xml, 'timePrd', {})]
+
+        def walk():
+            return [dconverter._find_all(start_tag, name, **attrs)
+                    for start_tag, name, attrs in searches]
+
+        def index():
+            doc_index = dconverter.DocumentIndex(ddi_xml)
+            return [doc_index.find_all(start_tag, name, **attrs)
+                    for start_tag, name, attrs in searches]
+
+        self.assertEquals(index(), walk())
+        before = _bench('Extractor searches on nr1, walk per field', walk,
+                        number=200)
+        after = _bench('Extractor searches on nr1, document index', index,
+                       number=200)
+        log.info('Speedup: {sp:.1f}x'.format(sp=before / after))
+        assert after < before
+
+    def test_flatten(self):
+        sections = []
+        for path in FIXTURES:
+            with open(path) as f:
+                ddi_xml = dconverter.parse_ddi(f.read())
+            sections.extend(ddi_xml.iterchildren('docDscr', 'stdyDscr'))
+
+        def reader():
+            return [importcore.generic_xml_metadata_reader(section).getMap()
+                    for section in sections]
+
+        def flatten():
+            return [flattener.flatten(section) for section in sections]
+
+        self.assertEquals(flatten(), reader())
+        keys = sum(len(xpaths) for xpaths in flatten())
+        before = _bench('Flatten fixtures ({n} keys), importcore'.format(
+            n=keys), reader, number=10)
+        after = _bench('Flatten fixtures ({n} keys), flattener'.format(
+            n=keys), flatten, number=10)
+        log.info('Speedup: {sp:.1f}x'.format(sp=before / after))
+        assert after < before
+
+    def test_compressed_xpaths(self):
+        harvest_model.setup()
+        context = {'model': model, 'session': model.Session,
+                   'user': u'benchmark', 'ignore_auth': True}
+        org = get_action('organization_create')(context.copy(),
+                                                {'name': u'benchmark'})
+        docs = []
+        for path in FIXTURES:
+            with open(path) as f:
+                docs.append((path, f.read()))
+        # The study with the most flattened xpaths
+        largest, xml = max(docs, key=lambda (path, xml): len(
+            flattener.flatten(dconverter.parse_ddi(xml).find('stdyDscr'))))
+        converter = dconverter.DataConverter()
+        package_dict = converter.ddi2ckan(
+            dconverter.parse_ddi(xml), u'http://www.fsd.uta.fi/FSD.xml', xml,
+            context={'user': u'benchmark'}, owner_org=org['name'])
+        schema = dharvester.DDIHarvester()._get_package_schema()
+        results = []
+        for label, xpaths in (
+                ('extra per key', package_dict['xpaths']),
+                ('compressed', flattener.pack(package_dict['xpaths']))):
+            pkg = dict(package_dict, xpaths=xpaths,
+                       name=package_dict['name'] + str(len(results)))
+            package_id = get_action('package_create')(
+                dict(context, schema=schema), pkg)['id']
+            rows = model.Session.query(model.PackageExtra) \
+                .filter(model.PackageExtra.package_id == package_id).count()
+            log.info('Package extras of {fi}, {la}: {ro} rows'.format(
+                fi=os.path.basename(largest), la=label, ro=rows))
+            show = _bench('package_show, {la}'.format(la=label),
+                          lambda: get_action('package_show')(
+                              dict(context, use_cache=False),
+                              {'id': package_id}),
+                          number=10)
+            results.append((rows, show))
+        model.repo.rebuild_db()
+        (before_rows, before), (after_rows, after) = results
+        log.info('Speedup: {sp:.1f}x'.format(sp=before / after))
+        assert after_rows < before_rows
+
+    def test_gather_batch_insert(self):
+        harvest_model.setup()
+        source = harvest_model.HarvestSource(url=u'http://localhost/ddi.txt',
+                                             type=u'DDI')
+        source.save()
+        job = harvest_model.HarvestJob(source=source)
+        job.save()
+        urls = [u'http://localhost/FSD%d.xml\n' % i for i in range(300)]
+        harvester = dharvester.DDIHarvester()
+        harvester.config = {}
+
+        def per_object():
+            for url in urls:
+                obj = harvest_model.HarvestObject(job=job, guid=url.strip())
+                obj.content = url
+                obj.save()
+
+        before = _bench('Gather 300 objects, save per object', per_object,
+                        number=1)
+        after = _bench('Gather 300 objects, batches of 500',
+                       lambda: harvester._add_harvest_objects(job, urls),
+                       number=1)
+        log.info('Speedup: {sp:.1f}x'.format(sp=before / after))
+        model.repo.rebuild_db()
+        assert after < before
+
+    def test_conversion_processes(self):
+        work = []
+        for path in FIXTURES * 4:
+            with open(path) as f:
+                xml = f.read()
+            url = u'http://www.fsd.uta.fi/' + os.path.basename(path)
+            blob = dconverter.store_document(xml, u'benchmark', url,
+                                             dconverter.content_hash(xml))
+            work.append(({'url': url, 'xml': '', 'blob': blob},
+                         u'benchmark', dharvester._xpath_options({})))
+        processes = multiprocessing.cpu_count()
+        dharvester._init_conversion_worker()
+        pool = multiprocessing.Pool(processes,
+                                    initializer=dharvester._init_conversion_worker)
+        try:
+            before = _bench('Convert {n} documents in process'.format(
+                n=len(work)), lambda: map(dharvester._convert_in_worker, work),
+                number=1)
+            after = _bench('Convert {n} documents in {pr} processes'.format(
+                n=len(work), pr=processes),
+                lambda: pool.map(dharvester._convert_in_worker, work,
+                                 chunksize=1), number=1)
+        finally:
+            pool.terminate()
+        log.info('Speedup: {sp:.1f}x'.format(sp=before / after))
+        if processes > 1:
+            assert after < before
@@ -7,16 +7,24 @@ Tests for DDI harvester
 # import logging
 # import urllib2
 # from StringIO import StringIO
-# import json
+import contextlib
+import json
 # import uuid
 # import pprint
 # from datetime import datetime, timedelta
+import datetime
+import glob
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import StringIO
+import threading
 import unittest
 
 # from nose.exc import SkipTest
-# from lxml import etree
+from lxml import etree
+import mock
 # from sqlalchemy.ext.associationproxy import _AssociationDict
-import bs4
 
 # from ckan.model import Session, Package, User
 # from ckan.lib.helpers import url_for
@@ -25,18 +33,70 @@ import bs4
 # from ckan.logic.auth.get import package_show, group_show
 # from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject, \
 #                                   HarvestObjectError, HarvestGatherError, setup
+import ckan.lib.search
+import ckan.logic
 import ckan.model
 import ckanext.harvest.model as harvest_model
 from ckanext.kata import model as kata_model
+import ckanext.oaipmh.importcore as importcore
 # from ckanext.ddi.harvester import DDIHarvester
 import ckanext.ddi.harvester as dharvester
 import ckanext.ddi.dataconverter as dconverter
+import ckanext.ddi.envelope as envelope
+import ckanext.ddi.flattener as flattener
+import test_httpclient
 import testdata
 
 
 # log = logging.getLogger(__file__)
 # realopen = urllib2.urlopen
 
+FSD_FIXTURES = sorted(glob.glob(os.path.join(
+    os.path.dirname(__file__), '..', 'test_fixtures', 'FSD*.xml')))
+
+
+class _SearchBackend(object):
+    '''Stand-in for the CKAN search backend recording the indexed packages,
+    see :class:`ckanext.ddi.searchindex.SearchBackend`.
+    '''
+
+    def __init__(self):
+        self.suppressed = False
+        self.indexed = []
+
+    @contextlib.contextmanager
+    def automatic_indexing_suppressed(self):
+        suppressed, self.suppressed = self.suppressed, True
+        try:
+            yield
+        finally:
+            self.suppressed = suppressed
+
+    def index_packages(self, package_ids):
+        if package_ids:
+            self.indexed.append(sorted(package_ids))
+
+
+class _OFS(object):
+    '''Stand-in for the OFS storage of CKAN keeping the files in memory.
+    '''
+
+    def __init__(self):
+        # Label -> (data, metadata)
+        self.files = {}
+
+    def exists(self, bucket, label):
+        return label in self.files
+
+    def put_stream(self, bucket, label, stream, params):
+        self.files[label] = (stream, dict(params))
+
+    def get_stream(self, bucket, label):
+        return StringIO.StringIO(self.files[label][0])
+
+    def get_metadata(self, bucket, label):
+        return self.files[label][1]
+
 
 class TestDataConverter(unittest.TestCase):
 
@@ -51,7 +111,7 @@ class TestDataConverter(unittest.TestCase):
         cls.ddi_converter = dconverter.DataConverter()
 
         # cls.ddi_xml = testdata.nr1
-        cls.ddi_xml = bs4.BeautifulSoup(testdata.nr1, 'xml')
+        cls.ddi_xml = dconverter.parse_ddi(testdata.nr1)
 
         # username = u'testlogin2'
         # password = u'letmein'
@@ -69,17 +129,306 @@ class TestDataConverter(unittest.TestCase):
 
     def test_get_discipline(self):
         discipline = self.ddi_converter.get_discipline(
-            self.ddi_xml.stdyDscr.stdyInfo.subject)
+            self.ddi_xml.find('stdyDscr/stdyInfo/subject'))
         assert discipline == u'politiikantutkimus'
 
     def test_get_keywords(self):
         keywords = self.ddi_converter.get_keywords(
-            self.ddi_xml.stdyDscr.stdyInfo.subject)
+            self.ddi_xml.find('stdyDscr/stdyInfo/subject'))
         assert keywords == u'vaalit,eduskuntavaalit,kunnallisvaalit,' \
                            u'äänestäminen,poliittinen käyttäytyminen,' \
                            u'poliittiset asenteet,puolueiden kannatus,' \
                            u'poliittinen käyttäytyminen, asenteet ja mielipiteet'
 
+    def test_convert_keeps_tree(self):
+        ddi_xml = dconverter.parse_ddi(testdata.nr1)
+        before = etree.tostring(ddi_xml)
+        package_dict, _ = dconverter.DataConverter().convert(
+            ddi_xml, u'http://www.fsd.uta.fi/FSD1008.xml', testdata.nr1,
+            original_label=u'test/FSD1008.xml', owner_org=u'')
+        self.assertEquals(etree.tostring(ddi_xml), before)
+        self.assertEquals(package_dict['discipline'], u'politiikantutkimus')
+        assert package_dict['geographic_coverage']
+        # Classified elements are flattened too
+        assert [key for key in package_dict['xpaths']
+                if key.startswith('stdyDscr/stdyInfo.0/subject.0/keyword')]
+
+    def test_document_index(self):
+        ddi_xml = dconverter.parse_ddi(
+            '<codeBook>%s</codeBook>' % ''.join(
+                '<stdyDscr><citation><prodStmt><prodDate>%d</prodDate>'
+                '</prodStmt></citation></stdyDscr>' % n for n in range(1, 11)))
+        doc_index = dconverter.DocumentIndex(ddi_xml)
+        study = ddi_xml.find('stdyDscr')
+        assert doc_index.covers(study, 'prodDate')
+        self.assertEquals([el.text for el in
+                           doc_index.find_all(study, 'prodDate')], ['1'])
+        self.assertEquals(len(doc_index.find_all(ddi_xml, 'prodDate')), 10)
+        self.assertEquals(doc_index.find_all(study.find('citation/prodStmt'),
+                                             'prodDate'),
+                          dconverter._find_all(study.find('citation/prodStmt'),
+                                               'prodDate'))
+
+    def test_parse_ddi_malformed(self):
+        # Unclosed tag is repaired by the BeautifulSoup fallback
+        ddi_xml = dconverter.parse_ddi('<codeBook><docDscr>FSD</codeBook>')
+        self.assertEquals(ddi_xml.findtext('docDscr'), u'FSD')
+
+    def test_parse_ddi_namespaced(self):
+        ddi_xml = dconverter.parse_ddi(
+            '<codeBook xmlns="ddi:codebook:2_5"><stdyDscr><citation/>'
+            '</stdyDscr></codeBook>')
+        self.assertEquals(ddi_xml.tag, 'codeBook')
+        assert ddi_xml.find('stdyDscr/citation') is not None
+
+    def test_read_value(self):
+        converter = dconverter.DataConverter()
+        converter.ddi_xml = dconverter.parse_ddi(
+            '<codeBook><docDscr><citation><titlStmt><IDNo agency="FSD">1008'
+            '</IDNo></titlStmt></citation></docDscr></codeBook>')
+        # Falls back to docDscr when stdyDscr has no IDNo
+        self.assertEquals(converter._read_value('name_prefix'), 'FSD')
+        self.assertEquals(converter._read_value('name_id'), '1008')
+        self.assertEquals(converter._read_value('contact_email'), u'')
+        self.assertEquals(converter.get_errors(),
+                          [('Unable to read mandatory value: contact_email',
+                            None)])
+
+    def test_except_return_field(self):
+        converter = dconverter.DataConverter()
+        self.assertEquals(converter.get_authors(None), u'')
+        self.assertEquals(converter.get_discipline(None), u'')
+        errors = converter.get_errors()
+        # Only the mandatory field is an error
+        self.assertEquals(len(errors), 1)
+        assert errors[0][0].endswith(' at authors')
+
+    def test_concurrent_conversions(self):
+        docs = [testdata.nr1, testdata.nr2,
+                '<codeBook><stdyDscr><citation><titlStmt><titl>Title</titl>'
+                '</titlStmt></citation></stdyDscr></codeBook>'] * 4
+        converter = dconverter.DataConverter()
+
+        def convert(xml):
+            package_dict, errors = converter.convert(
+                dconverter.parse_ddi(xml), u'http://www.fsd.uta.fi/FSD.xml',
+                xml, original_label=u'test/FSD.xml', owner_org=u'')
+            if package_dict:
+                package_dict.pop('id')
+            return package_dict, errors
+
+        expected = map(convert, docs)
+        assert expected[2][1]
+        pool = ThreadPool(4)
+        try:
+            for _ in range(3):
+                self.assertEquals(pool.map(convert, docs, chunksize=1),
+                                  expected)
+        finally:
+            pool.close()
+        # Errors of the last conversion of this thread are kept
+        self.assertEquals(converter.get_errors(), expected[-1][1])
+
+    def test_flatten(self):
+        docs = [testdata.nr1, testdata.nr2,
+                u'<codeBook xmlns:x="urn:x"><stdyDscr x:id="s" xml:lang="fi">'
+                u'<!-- comment --><tiivistelmä>Hyvä</tiivistelmä><p> </p>'
+                u'<p>a<b/>b</p></stdyDscr></codeBook>']
+        for xml in docs:
+            ddi_xml = dconverter.parse_ddi(xml)
+            for element in ddi_xml.iterchildren('docDscr', 'stdyDscr'):
+                self.assertEquals(
+                    flattener.flatten(element),
+                    importcore.generic_xml_metadata_reader(element).getMap())
+
+    def test_flatten_fixtures(self):
+        # The keys are saved as 'xpaths' extras, they must stay those of the
+        # importcore flattening of the documents
+        assert FSD_FIXTURES
+        for path in FSD_FIXTURES:
+            with open(path) as f:
+                xml = f.read()
+            root = etree.fromstring(xml)
+            expected = importcore.generic_xml_metadata_reader(
+                root.find('.//{*}docDscr')).getMap()
+            expected.update(importcore.generic_xml_metadata_reader(
+                root.find('.//{*}stdyDscr')).getMap())
+            ddi_xml = dconverter.parse_ddi(xml)
+            xpaths = flattener.flatten(ddi_xml.find('.//stdyDscr'),
+                                       flattener.flatten(
+                                           ddi_xml.find('.//docDscr')))
+            self.assertEquals(xpaths, expected, path)
+
+    def test_xpath_matcher(self):
+        stdy_dscr = dconverter.parse_ddi(testdata.nr1).find('stdyDscr')
+        xpaths = flattener.flatten(stdy_dscr)
+
+        def under(key, prefix):
+            # Key without numbering and attribute
+            tags = '/'.join(tag.split('.')[0]
+                            for tag in key.split('/@')[0].split('/'))
+            return (tags + '/').startswith(prefix + '/')
+
+        matcher = flattener.XPathMatcher(
+            include=['stdyDscr/citation', 'stdyDscr/stdyInfo'],
+            exclude=['stdyDscr/stdyInfo/subject'])
+        expected = dict((key, value) for key, value in xpaths.iteritems()
+                        if (under(key, 'stdyDscr/citation') or
+                            under(key, 'stdyDscr/stdyInfo')) and
+                        not under(key, 'stdyDscr/stdyInfo/subject'))
+        assert expected
+        self.assertEquals(matcher.flatten(stdy_dscr), expected)
+        matcher = flattener.XPathMatcher(exclude=['stdyDscr/othrStdyMat'])
+        self.assertEquals(matcher.flatten(stdy_dscr),
+                          dict((key, value) for key, value in xpaths.iteritems()
+                               if not under(key, 'stdyDscr/othrStdyMat')))
+        self.assertEquals(flattener.XPathMatcher().flatten(stdy_dscr), xpaths)
+
+    def test_pack_xpaths(self):
+        xpaths = flattener.flatten(
+            dconverter.parse_ddi(testdata.nr1).find('stdyDscr'))
+        whitelist = flattener.XPathMatcher(
+            include=['stdyDscr/citation/titlStmt'])
+        packed = flattener.pack(xpaths, whitelist)
+        kept = [key for key in packed if key != flattener.PACKED_KEY]
+        assert kept
+        assert all(key.startswith('stdyDscr/citation.0/titlStmt.0/')
+                   for key in kept)
+        self.assertEquals(flattener.unpack(packed[flattener.PACKED_KEY]),
+                          xpaths)
+        extras = [{'key': key, 'value': value}
+                  for key, value in packed.iteritems()]
+        extras.append({'key': 'contact_0_name', 'value': u'FSD'})
+        lazy = flattener.XPaths(extras)
+        self.assertEquals(lazy[kept[0]], xpaths[kept[0]])
+        # Kept keys are read without unpacking
+        self.assertEquals(lazy._xpaths, None)
+        self.assertEquals(dict(lazy), xpaths)
+        self.assertEquals(dict(flattener.XPaths(xpaths)), xpaths)
+
+    def test_packed_xpaths_saved(self):
+        context = {'model': ckan.model, 'session': ckan.model.Session,
+                   'user': u'testlogin', 'ignore_auth': True}
+        org = ckan.logic.get_action('organization_create')(
+            context.copy(), {'name': u'packed-xpaths'})
+        package_dict = self.ddi_converter.ddi2ckan(
+            dconverter.parse_ddi(testdata.nr1),
+            u'http://www.fsd.uta.fi/FSD1008.xml', testdata.nr1,
+            context={'user': u'testlogin'}, owner_org=org['name'])
+        xpaths = package_dict['xpaths']
+        package_dict['xpaths'] = flattener.pack(xpaths, flattener.XPathMatcher(
+            include=['stdyDscr/citation/titlStmt']))
+        harvester = dharvester.DDIHarvester()
+        package_id = ckan.logic.get_action('package_create')(
+            dict(context, schema=harvester._get_package_schema()),
+            package_dict)['id']
+        shown = ckan.logic.get_action('package_show')(
+            dict(context, use_cache=False), {'id': package_id})
+        self.assertEquals(dict(flattener.XPaths(shown['extras'])), xpaths)
+        # Index the package with the search connection replaced
+        with mock.patch.object(ckan.lib.search.index,
+                               'make_connection') as make_connection:
+            ckan.lib.search.index_for(ckan.model.Package) \
+                .index_package(shown)
+        conn = make_connection.return_value
+        if conn.add_many.called:
+            # solrpy
+            doc = conn.add_many.call_args[0][0][0]
+        else:
+            # pysolr
+            doc = conn.add.call_args[1]['docs'][0]
+        # The whitelisted xpaths are indexed, the packed ones are not
+        assert any(key.startswith('extras_stdyDscr') for key in doc)
+        for key in doc:
+            assert 'xpaths' not in key, key
+
+    def test_store_document_replaced(self):
+        ofs = _OFS()
+        url = u'http://www.fsd.uta.fi/FSD1008.xml'
+        with mock.patch.object(dconverter.storage, 'get_ofs',
+                               return_value=ofs):
+            label = dconverter.store_document(
+                testdata.nr1, u'source', url,
+                dconverter.content_hash(testdata.nr1))
+            # A changed document replaces the previous one
+            self.assertEquals(dconverter.store_document(
+                testdata.nr2, u'source', url,
+                dconverter.content_hash(testdata.nr2)), label)
+            self.assertEquals(ofs.files.keys(), [label])
+            self.assertEquals(dconverter.load_document(label), testdata.nr2)
+            # An identical one is not written again
+            with mock.patch.object(ofs, 'put_stream') as put_stream:
+                dconverter.store_document(
+                    testdata.nr2, u'source', url,
+                    dconverter.content_hash(testdata.nr2))
+            assert not put_stream.called
+
+    @mock.patch.object(dconverter, 'storage_url',
+                       lambda label: u'http://localhost/storage/f/' + label)
+    def test_save_original_xml_unchanged(self):
+        ofs = _OFS()
+        harvest_object = harvest_model.HarvestObject(
+            harvest_source_id=u'source')
+        converter = dconverter.DataConverter()
+        with mock.patch.object(dconverter.storage, 'get_ofs',
+                               return_value=ofs):
+            url = converter._save_original_xml(testdata.nr1, u'FSD1008',
+                                               harvest_object)
+            self.assertEquals(url, u'http://localhost/storage/f/'
+                                   u'source/FSD1008.xml')
+            with mock.patch.object(ofs, 'put_stream') as put_stream:
+                self.assertEquals(converter._save_original_xml(
+                    testdata.nr1, u'FSD1008', harvest_object), url)
+            assert not put_stream.called
+            # A changed document is written over the previous one
+            self.assertEquals(converter._save_original_xml(
+                testdata.nr2, u'FSD1008', harvest_object), url)
+            self.assertEquals(
+                dconverter.load_document(u'source/FSD1008.xml'),
+                testdata.nr2)
+
+    def test_owner_org_cached_per_job(self):
+        converter = dconverter.DataConverter()
+
+        def harvest_object(source_id, job_id):
+            return harvest_model.HarvestObject(harvest_source_id=source_id,
+                                               harvest_job_id=job_id)
+
+        with mock.patch.object(dconverter.model, 'Session') as session:
+            query = session.query.return_value.join.return_value \
+                .filter.return_value
+            query.one.return_value = (u'fsd',)
+            for obj in (harvest_object(u'source1', u'job1'),
+                        harvest_object(u'source1', u'job1'),
+                        harvest_object(u'source2', u'job2'),
+                        harvest_object(u'source1', u'job1'),
+                        # The organization may have changed for a new job
+                        harvest_object(u'source1', u'job3')):
+                self.assertEquals(converter.get_owner_org(obj), u'fsd')
+        self.assertEquals(query.one.call_count, 3)
+
+    def test_iter_ddi_vars(self):
+        heads = dconverter._get_headers()
+        ddi_xml = dconverter.parse_ddi(testdata.nr1)
+        expected = [(dconverter._construct_csv(var, heads),
+                     dconverter._create_code_rows(var))
+                    for var in ddi_xml.iterfind('dataDscr/var')]
+        streamed = [(dconverter._construct_csv(var, heads),
+                     dconverter._create_code_rows(var))
+                    for var in dconverter._iter_ddi_vars(testdata.nr1)]
+        assert expected
+        self.assertEquals(streamed, expected)
+        self.assertEquals(streamed[0][0]['range'], '(max,1008)(min,1008)')
+
+    def test_iter_ddi_vars_malformed(self):
+        malformed = '<codeBook><dataDscr><var name="a"/><var name="b">' \
+                    '</dataDscr></codeBook>'
+        self.assertRaises(etree.XMLSyntaxError, list,
+                          dconverter._iter_ddi_vars(malformed))
+        self.assertEquals([var.get('name') for var in
+                           dconverter._iter_ddi_vars(malformed, recover=True)
+                           ][:1], ['a'])
+
     def test_convert_language(self):
         self.assertEquals(self.ddi_converter.convert_language('fi'), 'fin')
         self.assertEquals(self.ddi_converter.convert_language('en'), 'eng')
@@ -116,8 +465,399 @@ class TestDDIHarvester(unittest.TestCase):
         # res = fv.submit()
         # setup()
 
-    def test_dummy(self):
-        assert 1
+    def setUp(self):
+        self.search_backend = _SearchBackend()
+        self.harvester = self._harvester()
+        # Objects of the harvest job in the order they are handled
+        self.objects = []
+        # Guid -> previous harvest object
+        self.previous = {}
+        # Names of the written packages
+        self.written = []
+        # Names of the packages written with automatic indexing suppressed
+        self.unindexed = []
+        patcher = mock.patch.object(dharvester.model, 'Session')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _harvester(self):
+        '''Return a harvester with the database access of the harvest job
+        replaced by the state of the test.
+        '''
+        harvester = dharvester.DDIHarvester(
+            search_backend=self.search_backend)
+        harvester._previous_object = lambda obj: self.previous.get(obj.guid)
+        harvester._pending_objects = lambda obj: len([
+            other for other in self.objects if other is not obj and
+            other.state in dharvester.PENDING_STATES and
+            not dharvester._get_extra(other, dharvester.DONE_EXTRA)])
+        harvester._job_package_ids = lambda job_id: list(self.written)
+        harvester._stranded_objects = lambda job_id: []
+        harvester._claim_queued = lambda batch: batch
+        harvester._convert = lambda obj, info: {
+            'id': None, 'name': info['url'].rsplit('/', 1)[-1][:-4]}
+        harvester._write_package = self._write_package
+        harvester._save_object_error = mock.Mock()
+        return harvester
+
+    def _import(self, harvest_object, harvester=None):
+        '''Run the import stage like a harvest consumer, which sets the state
+        of the object from the result.
+        '''
+        result = (harvester or self.harvester).import_stage(harvest_object)
+        harvest_object.state = u'COMPLETE' if result else u'ERROR'
+        return result
+
+    def _fetch(self, harvest_object, harvester=None):
+        '''Run the fetch stage like a harvest consumer, see :meth:`_import`.
+        '''
+        result = (harvester or self.harvester).fetch_stage(harvest_object)
+        if result is not True:
+            harvest_object.state = u'COMPLETE' if result else u'ERROR'
+        return result
+
+    def _write_package(self, package_dict, harvest_object):
+        if package_dict['name'] == u'bad':
+            raise ckan.logic.ValidationError({'name': [u'Invalid name']})
+        self.written.append(package_dict['name'])
+        if self.search_backend.suppressed:
+            self.unindexed.append(package_dict['name'])
+        harvest_object.package_id = package_dict['name']
+        harvest_object.current = True
+        return package_dict['name']
+
+    def _job(self, names, **config):
+        '''Create the fetched harvest objects of a job with a document named
+        after each of 'names'.
+        '''
+        source = harvest_model.HarvestSource(config=json.dumps(config))
+        job = harvest_model.HarvestJob(source=source)
+        for name in names:
+            url = u'http://www.fsd.uta.fi/{na}.xml'.format(na=name)
+            xml = u'<codeBook>{na}</codeBook>'.format(na=name)
+            self.objects.append(harvest_model.HarvestObject(
+                id=name, guid=url, job=job, harvest_job_id=u'job',
+                harvest_source_id=u'source', state=u'IMPORT', extras=[],
+                content=envelope.encode(url, xml, content_hash=
+                                        dconverter.content_hash(xml))))
+        return self.objects
+
+    def _unchanged(self, harvest_object):
+        '''Make the document of 'harvest_object' the same as the previously
+        imported one.
+        '''
+        info = envelope.decode(harvest_object.content)
+        self.previous[harvest_object.guid] = harvest_model.HarvestObject(
+            id=u'previous', package_id=u'previous', extras=[
+                harvest_model.HarvestObjectExtra(
+                    key=u'content_hash', value=info['content_hash'])])
+
+    def test_filter_by_last_modified(self):
+        start = datetime.datetime(2013, 11, 5)
+        day = datetime.timedelta(days=1)
+        # Modified on day n, FSD0 unknown
+        urls = [u'http://www.fsd.uta.fi/FSD{n}.xml'.format(n=n)
+                for n in range(40)]
+        lastmods = dict((url, start + n * day if n else None)
+                        for n, url in enumerate(urls))
+        self.harvester.config = {'probe_concurrency': 3}
+        self.harvester._probe_last_modified = lambda url: (url, lastmods[url])
+        self.assertEquals(
+            list(self.harvester._filter_by_last_modified(
+                iter(urls), start + 10 * day, start + 30 * day)),
+            urls[:1] + urls[10:31])
+        self.assertEquals(
+            list(self.harvester._filter_by_last_modified(
+                urls, start + 35 * day, None)),
+            urls[:1] + urls[35:])
+
+    def test_read_fetched_unchanged(self):
+        objects = self._job([u'FSD1', u'FSD2'])
+        self._unchanged(objects[0])
+        self.harvester.config = {}
+        self.assertEquals(self.harvester._read_fetched(objects[0]),
+                          'unchanged')
+        self.assertEquals(self.harvester._read_fetched(objects[1])['xml'],
+                          u'<codeBook>FSD2</codeBook>')
+        # A changed document
+        self.previous[objects[1].guid] = self.previous[objects[0].guid]
+        assert self.harvester._read_fetched(objects[1]) != 'unchanged'
+        self.harvester.config = {'force_all': True}
+        self.assertEquals(self.harvester._read_fetched(objects[0])['url'],
+                          objects[0].guid)
+
+    def test_unchanged_package(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'])
+        self.harvester.config = {}
+        original = {'url': u'http://localhost/storage/f/source/FSD1.xml',
+                    'resource_type': 'file.harvest', 'hash': u'1'}
+        package_dict = {'id': u'1', 'name': u'fsd1', 'title': u'Title',
+                        'resources': [original]}
+        # No previous import
+        assert not self.harvester._unchanged_package(objects[0],
+                                                     package_dict)
+        objects[0].package_id = u'fsd1'
+        self.previous[objects[1].guid] = objects[0]
+        # The id and the storage of the original metadata do not count
+        same = dict(package_dict, id=None, resources=[
+            dict(original, url=u'http://localhost/other.xml', hash=u'2')])
+        assert self.harvester._unchanged_package(objects[1], same)
+        self.assertEquals(objects[1].package_id, u'fsd1')
+        assert objects[1].current and not objects[0].current
+        self.previous[objects[2].guid] = objects[0]
+        assert not self.harvester._unchanged_package(
+            objects[2], dict(package_dict, title=u'New title'))
+        self.harvester.config = {'force_all': True}
+        assert not self.harvester._unchanged_package(objects[2],
+                                                     package_dict)
+
+    def _serve(self):
+        '''Start the HTTP server of the HTTP client tests and return its URL.
+        '''
+        server = test_httpclient._Server(('127.0.0.1', 0),
+                                         test_httpclient._Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        test_httpclient._Handler.connections.clear()
+        test_httpclient._Handler.requests = []
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def _fetch_job(self, url, n, **config):
+        '''Create 'n' harvest objects of a job for fetching 'url'.
+        '''
+        objects = self._job([u'doc{n}'.format(n=i) for i in range(n)],
+                            **config)
+        for obj in objects:
+            obj.guid = obj.content = url
+        return objects
+
+    def _gather(self, url, **config):
+        '''Run the gather stage of a job for the listing at 'url'. Returns
+        the job.
+        '''
+        source = harvest_model.HarvestSource(url=url,
+                                             config=json.dumps(config))
+        job = harvest_model.HarvestJob(source=source)
+        self.harvester._filter_by_last_modified = \
+            lambda urls, from_, until: urls
+        self.harvester._discard_gathered = mock.Mock()
+        self.harvester._save_gather_error = mock.Mock()
+        self.assertEquals(self.harvester.gather_stage(job), None)
+        return job
+
+    def test_gather_listing_cut(self):
+        job = self._gather(self._serve() + '/truncated.txt',
+                           gather_batch_size=1)
+        # The objects inserted before the listing ended are deleted
+        assert dharvester.model.Session.commit.called
+        self.harvester._discard_gathered.assert_called_once_with(job)
+        assert self.harvester._save_gather_error.called
+
+    def test_gather_connection_lost(self):
+        url = self._serve() + '/stalled.txt'
+        test_httpclient._Handler.release.clear()
+        self.addCleanup(test_httpclient._Handler.release.set)
+        self.addCleanup(socket.setdefaulttimeout, socket.getdefaulttimeout())
+        socket.setdefaulttimeout(0.5)
+        job = self._gather(url, gather_batch_size=50)
+        # Timed out in the middle of the listing
+        assert dharvester.model.Session.add_all.call_count > 1
+        self.harvester._discard_gathered.assert_called_once_with(job)
+        assert self.harvester._save_gather_error.called
+
+    @mock.patch.object(dharvester.dconverter, 'store_document',
+                       return_value=u'source/doc.xml')
+    def test_fetch_not_modified(self, _):
+        url = self._serve() + '/doc.xml'
+        objects = self._fetch_job(url, 2)
+        self.assertEquals(self.harvester.fetch_stage(objects[0]), True)
+        self.assertEquals(dharvester._get_extra(objects[0], 'etag'),
+                          test_httpclient.ETAG)
+        self.assertEquals(dharvester._get_extra(objects[0], 'last_modified'),
+                          test_httpclient.LAST_MODIFIED)
+        self.previous[url] = objects[0]
+        self.assertEquals(self.harvester.fetch_stage(objects[1]), 'unchanged')
+        headers = test_httpclient._Handler.requests[-1]
+        self.assertEquals(headers.get('If-None-Match'), test_httpclient.ETAG)
+        self.assertEquals(headers.get('If-Modified-Since'),
+                          test_httpclient.LAST_MODIFIED)
+        # The connection is kept after the body of 304 has been read
+        self.harvester._get_http_client().get(url).read()
+        self.assertEquals(len(test_httpclient._Handler.connections), 1)
+
+    @mock.patch.object(dharvester.dconverter, 'store_document',
+                       return_value=u'source/doc.xml')
+    def test_fetch_force_all(self, _):
+        url = self._serve() + '/doc.xml'
+        objects = self._fetch_job(url, 2, force_all=True)
+        self.harvester.fetch_stage(objects[0])
+        self.previous[url] = objects[0]
+        self.assertEquals(self.harvester.fetch_stage(objects[1]), True)
+        headers = test_httpclient._Handler.requests[-1]
+        self.assertEquals(headers.get('If-None-Match'), None)
+        self.assertEquals(headers.get('If-Modified-Since'), None)
+
+    def test_import_batch_last_object_unchanged(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], import_batch_size=10)
+        self._unchanged(objects[2])
+        results = [self._import(obj) for obj in objects]
+        self.assertEquals(results, [True, True, 'unchanged'])
+        self.assertEquals(self.written, [u'FSD1', u'FSD2'])
+        for obj in objects[:2]:
+            self.assertEquals(obj.state, 'COMPLETE')
+            self.assertEquals(dharvester._get_extra(
+                obj, dharvester.QUEUED_EXTRA), None)
+        self.assertEquals(self.search_backend.indexed, [[u'FSD1', u'FSD2']])
+
+    def test_import_batch_last_object_not_fetched(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], import_batch_size=10)
+        results = [self._import(obj) for obj in objects[:2]]
+        # Flagged while waiting in the batch
+        self.assertEquals(dharvester._get_extra(
+            objects[0], dharvester.QUEUED_EXTRA), 'true')
+        self.assertEquals(self.written, [])
+        with mock.patch.object(self.harvester, '_fetch',
+                               return_value='unchanged'):
+            results.append(self._fetch(objects[2]))
+        self.assertEquals(results, [True, True, 'unchanged'])
+        self.assertEquals(self.written, [u'FSD1', u'FSD2'])
+
+    def test_import_batch_objects_passing_through(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3', u'FSD4'],
+                            import_batch_size=10)
+        self._unchanged(objects[1])
+        with mock.patch.object(self.harvester, '_fetch',
+                               return_value='unchanged'):
+            self._fetch(objects[2])
+        results = [self._import(obj) for obj in objects[:2]]
+        # Objects leaving the harvester do not import the batch
+        self.assertEquals(results, [True, 'unchanged'])
+        self.assertEquals(self.written, [])
+        self._import(objects[3])
+        self.assertEquals(self.written, [u'FSD1', u'FSD4'])
+        self.assertEquals(self.search_backend.indexed, [[u'FSD1', u'FSD4']])
+
+    def test_import_batch_failing_record(self):
+        objects = self._job([u'FSD1', u'bad', u'FSD3', u'bad'],
+                            import_batch_size=3)
+        results = [self._import(obj) for obj in objects]
+        # The record failing in a batch of earlier objects is corrected
+        # after the batch, the one failing at hand is reported right away.
+        self.assertEquals(results, [True, True, True, False])
+        self.assertEquals(self.written, [u'FSD1', u'FSD3'])
+        self.assertEquals([obj.state for obj in objects],
+                          ['COMPLETE', 'ERROR', 'COMPLETE', 'ERROR'])
+        self.assertEquals(
+            [call[0][1] for call in
+             self.harvester._save_object_error.call_args_list],
+            [objects[1], objects[3]])
+        assert not objects[1].current
+
+    def test_import_stranded_objects(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], import_batch_size=10)
+        self.assertEquals([self._import(obj)
+                           for obj in objects[:2]], [True, True])
+        # The last object goes to another process
+        other = self._harvester()
+        other._stranded_objects = lambda job_id: [
+            obj for obj in objects
+            if dharvester._get_extra(obj, dharvester.QUEUED_EXTRA)]
+        self.assertEquals(self._import(objects[2], other), True)
+        self.assertEquals(self.written, [u'FSD3', u'FSD1', u'FSD2'])
+        self.assertEquals([obj.state for obj in objects], ['COMPLETE'] * 3)
+
+    @mock.patch.object(dharvester.dconverter, 'store_document',
+                       return_value=u'source/doc.xml')
+    @mock.patch.object(dharvester.multiprocessing, 'Pool')
+    def test_conversion_processes(self, Pool, _):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3', u'FSD4', u'FSD5'],
+                            import_batch_size=2, conversion_processes=4)
+        pool = Pool.return_value
+        pool.map.side_effect = lambda func, work, chunksize: [
+            {'id': None, 'name': info['url'].rsplit('/', 1)[-1][:-4]}
+            for info, _, _ in work]
+        self.harvester.ddi_converter.get_owner_org = lambda obj: u'org'
+        self.harvester._conversion_result = \
+            lambda obj, info, result: result
+        self.assertEquals([self._import(obj)
+                           for obj in objects], [True] * 5)
+        self.assertEquals(self.written,
+                          [u'FSD1', u'FSD2', u'FSD3', u'FSD4', u'FSD5'])
+        # Workers are started for each batch of two and stopped after it,
+        # the last object alone is converted in this process
+        self.assertEquals([call[0][0] for call in Pool.call_args_list],
+                          [2, 2])
+        self.assertEquals(pool.terminate.call_count, 2)
+        self.assertEquals(pool.join.call_count, 2)
+
+    def test_conversion_in_worker_processes(self):
+        objects = self._job([u'FSD1008', u'FSD1008'])
+        url = u'http://www.fsd.uta.fi/FSD1008.xml'
+        batch = [(obj, {'url': url, 'xml': testdata.nr1}) for obj in objects]
+        self.harvester.config = {'conversion_processes': 2}
+        self.harvester.ddi_converter.get_owner_org = lambda obj: u'org'
+        with mock.patch.object(dconverter.storage, 'get_ofs',
+                               return_value=_OFS()):
+            package_dicts = self.harvester._convert_batch(batch)
+            # Stored for the workers
+            info = batch[0][1]
+            assert info['blob'] and not info['xml']
+            expected = dharvester._convert_document(
+                dconverter.DataConverter(), info, owner_org=u'org')[0]
+        assert expected
+        for package_dict in package_dicts + [expected]:
+            package_dict.pop('id')
+        self.assertEquals(package_dicts, [expected, expected])
+
+    def test_defer_indexing(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], defer_indexing=True)
+        results = [self._import(obj) for obj in objects[:2]]
+        self.assertEquals(self.search_backend.indexed, [])
+        # The job is indexed even if its last object is not modified
+        with mock.patch.object(self.harvester, '_fetch',
+                               return_value='unchanged'):
+            results.append(self._fetch(objects[2]))
+        self.assertEquals(results, [True, True, 'unchanged'])
+        self.assertEquals(self.unindexed, [u'FSD1', u'FSD2'])
+        self.assertEquals(self.search_backend.indexed, [[u'FSD1', u'FSD2']])
+
+    def test_defer_indexing_import_batch(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], import_batch_size=2,
+                            defer_indexing=True)
+        for obj in objects:
+            self._import(obj)
+        self.assertEquals(self.unindexed, [u'FSD1', u'FSD2', u'FSD3'])
+        self.assertEquals(self.search_backend.indexed,
+                          [[u'FSD1', u'FSD2', u'FSD3']])
+
+    def test_defer_indexing_last_objects_in_two_processes(self):
+        objects = self._job([u'FSD1', u'FSD2'], defer_indexing=True)
+        # No harvest consumer saves the state of the first object before the
+        # other process counts the objects left
+        self._import(objects[0])
+        self._import(objects[1], self._harvester())
+        self.assertEquals(self.search_backend.indexed, [[u'FSD1', u'FSD2']])
+
+    def test_automatic_indexing(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'])
+        for obj in objects:
+            self._import(obj)
+        # Indexed one at a time after saving
+        self.assertEquals(self.unindexed, [u'FSD1', u'FSD2', u'FSD3'])
+        self.assertEquals(self.search_backend.indexed,
+                          [[u'FSD1'], [u'FSD2'], [u'FSD3']])
+        self.written = []
+        self.unindexed = []
+        self.search_backend.indexed = []
+        objects = self._job([u'FSD4', u'FSD5', u'FSD6'], import_batch_size=2)
+        for obj in objects[3:]:
+            self._import(obj)
+        self.assertEquals(self.unindexed, [u'FSD4', u'FSD5', u'FSD6'])
+        self.assertEquals(self.search_backend.indexed,
+                          [[u'FSD4', u'FSD5'], [u'FSD6']])
 
     @classmethod
     def teardown_class(self):
@@ -308,6 +1048,148 @@ class TestDDIHarvester(unittest.TestCase):
     #     print sum(diffs, timedelta)
     #
 
+class TestImportJob(unittest.TestCase):
+    '''Imports of a harvest job in two harvester processes with the harvest
+    objects in the database. Only converting and writing the packages are
+    replaced.
+    '''
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        kata_model.setup()
+        ckan.model.repo.new_revision()
+        for name in (u'fsd1', u'fsd2', u'fsd3'):
+            ckan.model.Session.add(ckan.model.Package(name=name,
+                                                      state=u'active'))
+        ckan.model.repo.commit_and_remove()
+
+    def setUp(self):
+        self.search_backend = _SearchBackend()
+        # Names of the written packages
+        self.written = []
+        # Package name -> title
+        self.titles = {}
+
+    def _harvester(self):
+        harvester = dharvester.DDIHarvester(
+            search_backend=self.search_backend)
+
+        def convert(harvest_object, info):
+            name = info['url'].rsplit('/', 1)[-1][:-4].lower()
+            return {'id': None, 'name': name,
+                    'title': self.titles.get(name, name)}
+        harvester._convert = convert
+        harvester._write_package = self._write_package
+        harvester._save_object_error = mock.Mock()
+        return harvester
+
+    def _write_package(self, package_dict, harvest_object):
+        self.written.append(package_dict['name'])
+        harvest_object.package_id = \
+            ckan.model.Package.by_name(package_dict['name']).id
+        harvest_object.current = True
+        ckan.model.Session.add(harvest_object)
+        return harvest_object.package_id
+
+    def _job(self, names, source=None, **config):
+        '''Create the fetched harvest objects of a job with a document named
+        after each of 'names'. A new source is created unless 'source' is
+        given.
+        '''
+        if source is None:
+            source = harvest_model.HarvestSource(
+                url=u'http://www.fsd.uta.fi/ddi.txt', type=u'DDI',
+                config=json.dumps(config))
+            source.save()
+        job = harvest_model.HarvestJob(source=source)
+        job.save()
+        objects = []
+        for name in names:
+            url = u'http://www.fsd.uta.fi/{na}.xml'.format(na=name)
+            xml = u'<codeBook>{na} {id}</codeBook>'.format(na=name, id=job.id)
+            obj = harvest_model.HarvestObject(
+                guid=url, job=job, state=u'IMPORT',
+                content=envelope.encode(url, xml, content_hash=
+                                        dconverter.content_hash(xml)))
+            obj.save()
+            objects.append(obj)
+        return objects
+
+    def _import(self, harvest_object, harvester):
+        '''Run the import stage like a harvest consumer, which saves the
+        state of the object from the result.
+        '''
+        result = harvester.import_stage(harvest_object)
+        harvest_object.state = u'COMPLETE' if result else u'ERROR'
+        harvest_object.save()
+        return result
+
+    def _flagged(self, objects, key):
+        '''Return the ids of 'objects' with extra 'key' in the database.
+        '''
+        return sorted(object_id for (object_id,) in
+                      ckan.model.Session.query(
+                          harvest_model.HarvestObjectExtra.harvest_object_id)
+                      .filter(harvest_model.HarvestObjectExtra.key == key)
+                      .filter(harvest_model.HarvestObjectExtra
+                              .harvest_object_id.in_(
+                                  [obj.id for obj in objects])))
+
+    def _package_ids(self, names):
+        return sorted(ckan.model.Package.by_name(name).id for name in names)
+
+    def test_stranded_objects_imported_once(self):
+        objects = self._job([u'FSD1', u'FSD2', u'FSD3'], import_batch_size=10,
+                            defer_indexing=True)
+        first, second = self._harvester(), self._harvester()
+        self.assertEquals([self._import(obj, first) for obj in objects[:2]],
+                          [True, True])
+        self.assertEquals(self._flagged(objects, dharvester.QUEUED_EXTRA),
+                          sorted(obj.id for obj in objects[:2]))
+        self.assertEquals(self.written, [])
+        # The last object goes to another process, which finishes the job
+        self.assertEquals(self._import(objects[2], second), True)
+        self.assertEquals(self.written, [u'fsd3', u'fsd1', u'fsd2'])
+        self.assertEquals(self._flagged(objects, dharvester.QUEUED_EXTRA), [])
+        self.assertEquals(self.search_backend.indexed, [
+            self._package_ids([u'fsd1', u'fsd2', u'fsd3'])])
+        # The batch left in the first process is not imported again
+        first._flush_imports()
+        self.assertEquals(self.written, [u'fsd3', u'fsd1', u'fsd2'])
+
+    def test_last_objects_in_two_processes(self):
+        objects = self._job([u'FSD1', u'FSD2'], defer_indexing=True)
+        # No harvest consumer saves the state of the first object before the
+        # other process counts the objects left
+        first, second = self._harvester(), self._harvester()
+        self.assertEquals(first.import_stage(objects[0]), True)
+        self.assertEquals(self.search_backend.indexed, [])
+        self.assertEquals(second.import_stage(objects[1]), True)
+        self.assertEquals(self.search_backend.indexed, [
+            self._package_ids([u'fsd1', u'fsd2'])])
+
+    def test_unchanged_packages_not_indexed(self):
+        objects = self._job([u'FSD1', u'FSD2'], defer_indexing=True)
+        harvester = self._harvester()
+        for obj in objects:
+            self._import(obj, harvester)
+        self.written = []
+        self.search_backend.indexed = []
+        # The documents have changed but only the package of FSD2
+        self.titles[u'fsd2'] = u'New title'
+        objects = self._job([u'FSD1', u'FSD2'], source=objects[0].source)
+        self.assertEquals([self._import(obj, harvester) for obj in objects],
+                          ['unchanged', True])
+        self.assertEquals(self.written, [u'fsd2'])
+        self.assertEquals(self.search_backend.indexed,
+                          [self._package_ids([u'fsd2'])])
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+
 #class TestDDI3Harvester(unittest.TestCase, FunctionalTestCase):
 #    @classmethod
 #    def setup_class(self):
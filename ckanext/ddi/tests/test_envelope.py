@@ -0,0 +1,39 @@
+# coding: utf-8
+'''
+Tests for the harvest object content envelope
+'''
+# pylint: disable=E1101,C1101,C0111
+
+import pickle
+import unittest
+
+import ckanext.ddi.envelope as envelope
+import testdata
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def test_round_trip(self):
+        content = envelope.encode(u'http://www.fsd.uta.fi/FSD1049.xml',
+                                  testdata.nr1, etag='"1049"')
+        assert content.startswith(envelope.PREFIX)
+        assert len(content) < len(testdata.nr1)
+        info = envelope.decode(unicode(content))
+        self.assertEquals(info['url'], u'http://www.fsd.uta.fi/FSD1049.xml')
+        self.assertEquals(info['etag'], '"1049"')
+        self.assertEquals(info['xml'], testdata.nr1)
+        self.assertEquals(type(info['xml']), type(testdata.nr1))
+
+    def test_unicode_xml(self):
+        xml = u'<codeBook><titl>Yhteiskuntatieteellinen ää</titl></codeBook>'
+        info = envelope.decode(envelope.encode(u'http://x', xml))
+        self.assertEquals(info['xml'], xml)
+        assert isinstance(info['xml'], unicode)
+
+    def test_legacy_pickle(self):
+        content = pickle.dumps({'url': 'http://x', 'xml': testdata.nr2})
+        self.assertEquals(envelope.decode(content),
+                          {'url': 'http://x', 'xml': testdata.nr2})
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, envelope.decode, envelope.PREFIX + '99:')
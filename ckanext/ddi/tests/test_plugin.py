@@ -0,0 +1,25 @@
+# coding: utf-8
+'''
+Tests for the search index plugin of DDI packages
+'''
+# pylint: disable=E1101,C1101,C0111
+
+import unittest
+
+import ckanext.ddi.flattener as flattener
+import ckanext.ddi.plugin as plugin
+
+
+class TestDDIIndexPlugin(unittest.TestCase):
+
+    def test_before_index(self):
+        packed = flattener.pack({'stdyDscr/citation/titlStmt/titl.0': u'T'})
+        pkg_dict = {'name': u'fsd1008', 'extras_xpathszlib': packed,
+                    'xpathszlib': packed, 'extras_contact_0_name': u'FSD'}
+        self.assertEquals(plugin.DDIIndexPlugin().before_index(pkg_dict),
+                          {'name': u'fsd1008',
+                           'extras_contact_0_name': u'FSD'})
+        # Other packages are indexed as they are
+        other = {'name': u'other', 'xpathszlib': u'Searchable'}
+        self.assertEquals(plugin.DDIIndexPlugin().before_index(dict(other)),
+                          other)
@@ -0,0 +1,78 @@
+# coding: utf-8
+'''
+Tests for suppressing the automatic indexing of CKAN
+'''
+# pylint: disable=E1101,C1101,C0111
+
+import threading
+import unittest
+
+import mock
+
+import ckanext.ddi.searchindex as searchindex
+
+
+class _SearchPlugin(object):
+    '''Stand-in for the search plugin of CKAN recording the notifications.
+    '''
+    notified = []
+
+    def notify(self, entity, operation):
+        _SearchPlugin.notified.append(entity)
+
+
+class TestSearchBackend(unittest.TestCase):
+
+    def setUp(self):
+        _SearchPlugin.notified = []
+        patcher = mock.patch.object(searchindex.search,
+                                    'SynchronousSearchPlugin', _SearchPlugin)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        notify = _SearchPlugin.__dict__['notify']
+        self.addCleanup(setattr, _SearchPlugin, 'notify', notify)
+
+    def _notify_in_thread(self, entity):
+        thread = threading.Thread(target=_SearchPlugin().notify,
+                                  args=(entity, 'changed'))
+        thread.start()
+        thread.join()
+
+    def test_automatic_indexing_suppressed(self):
+        backend = searchindex.SearchBackend()
+        plugin = _SearchPlugin()
+        with backend.automatic_indexing_suppressed():
+            plugin.notify('suppressed', 'new')
+            with backend.automatic_indexing_suppressed():
+                plugin.notify('nested', 'new')
+            plugin.notify('after nested', 'new')
+            # Other threads are indexed
+            self._notify_in_thread('other thread')
+        plugin.notify('after', 'new')
+        self.assertEquals(_SearchPlugin.notified, ['other thread', 'after'])
+
+    def test_search_plugin_restored(self):
+        backend = searchindex.SearchBackend()
+        original = _SearchPlugin.__dict__['notify']
+        entered = threading.Event()
+        leave = threading.Event()
+
+        def suppress():
+            with backend.automatic_indexing_suppressed():
+                entered.set()
+                leave.wait()
+        thread = threading.Thread(target=suppress)
+        thread.start()
+        entered.wait()
+        with backend.automatic_indexing_suppressed():
+            pass
+        # Replaced as long as another thread is in the context
+        assert _SearchPlugin.__dict__['notify'] is not original
+        leave.set()
+        thread.join()
+        self.assertEquals(_SearchPlugin.__dict__['notify'], original)
+        # Also after an error in the context
+        with self.assertRaises(ValueError):
+            with backend.automatic_indexing_suppressed():
+                raise ValueError()
+        self.assertEquals(_SearchPlugin.__dict__['notify'], original)
@@ -43,6 +43,7 @@ setup(
     entry_points="""
     [ckan.plugins]
     ddi_harvester=ckanext.ddi.harvester:DDIHarvester
+    ddi_index=ckanext.ddi.plugin:DDIIndexPlugin
     # ddi3_harvester=ckanext.ddi.harvester:DDI3Harvester
     [paste.paster_command]
     ddi_import = ckanext.ddi.commands:DDIImporter